@@ -0,0 +1,339 @@
+#!/usr/bin/python3
+import argparse
+import contextlib
+import datetime
+import gzip
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+import silentbot2
+
+class OfflinePool:
+    def __init__(self, start, blocks, lookup, authors=50):
+        self.nodes = ["offline"]
+        self.start = start
+        # Keep blocks as JSON text so 'fetching' pays for decoding like a real response would.
+        self.blocks = [json.dumps(block) for block in blocks]
+        self.lookup = lookup
+        self.following = [{"following": "author" + str(index)} for index in range(authors)]
+        self.broadcasts = 0
+
+    def ranked(self):
+        return self.nodes
+
+    def best(self):
+        return self.nodes[0]
+
+    def available(self, node):
+        return True
+
+    def head(self):
+        return self.start + len(self.blocks) - 1
+
+    def call(self, method, *args, api="condenser_api", node=None):
+        if method == "get_block_range":
+            first = args[0]["starting_block_num"] - self.start
+            last = min(first + args[0]["count"], len(self.blocks))
+            return {"blocks": json.loads("[" + ",".join(self.blocks[max(first, 0):last]) + "]")}
+        if method == "get_dynamic_global_properties":
+            return {
+                "head_block_number": self.head(),
+                "total_vesting_shares": "1.000000 VESTS",
+                "total_vesting_fund_hive": "1.000 HIVE"
+            }
+        if method == "get_accounts":
+            return [{
+                "name": name,
+                "vesting_shares": "0.000000 VESTS",
+                "delegated_vesting_shares": "0.000000 VESTS",
+                "received_vesting_shares": "0.000000 VESTS"
+            } for name in args[0]]
+        if method == "get_following":
+            return self.following
+        if method == "list_all_subscriptions":
+            return [[self.lookup["tribe"], "guest", "", ""]]
+        if method == "get_post":
+            return {
+                "created": datetime.datetime.utcnow().isoformat().split(".")[0],
+                "json_metadata": {"tags": [self.lookup["tribe"], self.lookup["tags"][0]]},
+                "percent_hbd": 10000
+            }
+        return []
+
+    def call_raw(self, method, params, api="condenser_api", node=None):
+        first = params["starting_block_num"] - self.start
+        last = min(first + params["count"], len(self.blocks))
+        return '{"jsonrpc":"2.0","result":{"blocks":[' + ",".join(self.blocks[max(first, 0):last]) + ']},"id":1}'
+
+    def vp(self, account):
+        return 100.0
+
+    def broadcast(self, op, wif):
+        self.broadcasts += 1
+        return {"id": str(self.broadcasts)}
+
+class OfflineEngine:
+    # Stands in for the hive-engine session so TokenStake never leaves the box.
+    def __init__(self):
+        self.posts = 0
+
+    def post(self, url, json=None):
+        self.posts += 1
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def json(self):
+        return {"result": []}
+
+def synthetic_blocks(lookup, count, transactions, mention_rate, post_rate, metadata_size, seed):
+    rnd = random.Random(seed)
+    bot = lookup["bot"]
+    curators = lookup["curators"]
+    filler = "x" * metadata_size
+    ts = datetime.datetime.utcnow() - datetime.timedelta(seconds=3 * count)
+    blocks = []
+    for blockno in range(count):
+        ops = []
+        for index in range(transactions):
+            author = "author" + str(rnd.randrange(500))
+            permlink = "post-" + str(blockno) + "-" + str(index)
+            roll = rnd.random()
+            if roll < mention_rate:
+                ops.append({"type": "comment_operation", "value": {
+                    "parent_author": author,
+                    "parent_permlink": "parent-" + str(blockno),
+                    "author": rnd.choice(curators),
+                    "permlink": "re-" + permlink,
+                    "title": "",
+                    "body": "@" + bot + " star " + str(rnd.randint(1, 5)),
+                    "json_metadata": json.dumps({"users": [bot], "app": "peakd/2021.01.1"})
+                }})
+            elif roll < mention_rate + post_rate:
+                ops.append({"type": "comment_operation", "value": {
+                    "parent_author": "",
+                    "parent_permlink": lookup["tribe"],
+                    "author": author,
+                    "permlink": permlink,
+                    "title": "Synthetic post",
+                    "body": "Lorem ipsum " * 40,
+                    "json_metadata": json.dumps({
+                        "app": "peakd/2021.01.1",
+                        "tags": [lookup["tribe"], rnd.choice(lookup["tags"]), "blog"],
+                        "image": [],
+                        "description": filler
+                    })
+                }})
+            elif roll < 0.6:
+                ops.append({"type": "comment_operation", "value": {
+                    "parent_author": "author" + str(rnd.randrange(500)),
+                    "parent_permlink": "some-post",
+                    "author": author,
+                    "permlink": "re-" + permlink,
+                    "title": "",
+                    "body": "Nice post!",
+                    "json_metadata": json.dumps({"app": "hiveblog/0.1", "users": ["someone"]})
+                }})
+            elif roll < 0.8:
+                ops.append({"type": "custom_json_operation", "value": {
+                    "required_auths": [],
+                    "required_posting_auths": [author],
+                    "id": "sm_find_match",
+                    "json": json.dumps({"match_type": "Ranked"})
+                }})
+            else:
+                ops.append({"type": "transfer_operation", "value": {
+                    "from": author,
+                    "to": "exchange",
+                    "amount": {"amount": "1000", "precision": 3, "nai": "@@000000021"},
+                    "memo": ""
+                }})
+        blocks.append({
+            "timestamp": (ts + datetime.timedelta(seconds=3 * blockno)).isoformat().split(".")[0],
+            "witness": "witness",
+            "transactions": [{"operations": [op]} for op in ops]
+        })
+    return blocks
+
+def load_fixture(path):
+    with gzip.open(path, "rt") as infil:
+        obj = json.load(infil)
+    return obj["start"], obj["blocks"]
+
+def record_fixture(path, start, count, nodes):
+    pool = silentbot2.ClientPool(nodes)
+    blocks = []
+    while len(blocks) < count:
+        batch = pool.call("get_block_range",
+                          {"starting_block_num": start + len(blocks), "count": min(100, count - len(blocks))},
+                          api="block_api")["blocks"]
+        blocks += batch
+        print("recorded", len(blocks), "of", count)
+    with gzip.open(path, "wt") as outfil:
+        json.dump({"start": start, "blocks": blocks}, outfil)
+
+class StageTimer:
+    def __init__(self):
+        self.stages = {}
+
+    def add(self, stage, seconds):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def wrap(self, stage, function):
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.add(stage, time.perf_counter() - start)
+        return timed
+
+def make_bot(lookup_path, lookup, pool):
+    wif_map = {name: "offline" for name in lookup["voters"] + [lookup["bot"]]}
+    return silentbot2.SilentBot(lookup["bot"], wif_map, lookup["curators"], lookup["voters"], lookup_path, pool,
+                                stake_session=OfflineEngine())
+
+def run_stages(bot, pool, window):
+    timer = StageTimer()
+    bot.responder.mention = timer.wrap("mention", bot.responder.mention)
+    bot.interest.match = timer.wrap("just_in_case", bot.interest.match)
+    bot.next = pool.start
+    blocks_done = 0
+    ops_done = 0
+    start_time = time.perf_counter()
+    while bot.next <= pool.head():
+        start = time.perf_counter()
+        blocks = pool.call("get_block_range", {"starting_block_num": bot.next, "count": window}, api="block_api")["blocks"]
+        timer.add("fetch", time.perf_counter() - start)
+        start = time.perf_counter()
+        for block in blocks:
+            bot.process_block(block)
+            for trans in block["transactions"]:
+                ops_done += len(trans["operations"])
+        timer.add("dispatch", time.perf_counter() - start)
+        blocks_done += len(blocks)
+        start = time.perf_counter()
+        bot.broadcaster.run(bot.voters)
+        timer.add("vote", time.perf_counter() - start)
+        start = time.perf_counter()
+        bot.sync()
+        timer.add("checkpoint", time.perf_counter() - start)
+    total = time.perf_counter() - start_time
+    return {
+        "blocks": blocks_done,
+        "ops": ops_done,
+        "seconds": total,
+        "blocks_per_sec": blocks_done / total,
+        "ops_per_sec": ops_done / total,
+        "stages": timer.stages
+    }
+
+def measure_memory(bot, pool, window):
+    # A separate pass, tracemalloc slows processing down too much to time it.
+    # Tracing starts after the fixture and bot exist, so only the processing
+    # peak counts.
+    tracemalloc.start()
+    try:
+        run_stages(bot, pool, window)
+        return tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+    finally:
+        tracemalloc.stop()
+
+def run_pipeline(bot, pool):
+    bot.next = pool.start
+    start_time = time.perf_counter()
+    blocks_done = silentbot2.MultiBot([bot]).upto_head()
+    total = time.perf_counter() - start_time
+    return {"blocks": blocks_done, "seconds": total, "blocks_per_sec": blocks_done / total}
+
+def compare(result, baseline, tolerance):
+    ok = True
+    for key in ["blocks_per_sec", "ops_per_sec", "pipeline_blocks_per_sec"]:
+        if key in result and key in baseline and baseline[key]:
+            ratio = result[key] / baseline[key]
+            print("%-26s %12.1f  baseline %12.1f  (%+.1f%%)" % (key, result[key], baseline[key], 100 * (ratio - 1)))
+            if ratio < 1 - tolerance:
+                ok = False
+    if "peak_alloc_mb" in result and baseline.get("peak_alloc_mb"):
+        ratio = result["peak_alloc_mb"] / baseline["peak_alloc_mb"]
+        print("%-26s %12.1f  baseline %12.1f  (%+.1f%%)" % ("peak_alloc_mb", result["peak_alloc_mb"], baseline["peak_alloc_mb"], 100 * (ratio - 1)))
+        if ratio > 1 + tolerance:
+            ok = False
+    for stage in sorted(result["stages"]):
+        if stage in baseline.get("stages", {}):
+            print("%-26s %12.3fs baseline %12.3fs" % ("stage " + stage, result["stages"][stage], baseline["stages"][stage]))
+    return ok
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline block processing benchmark for silentbot2")
+    parser.add_argument("--lookup", default=os.path.join(os.path.dirname(os.path.realpath(__file__)), "store", "sb-lookup.json"))
+    parser.add_argument("--fixture", help="gzipped JSON block fixture made with --record")
+    parser.add_argument("--record", nargs=2, type=int, metavar=("START", "COUNT"), help="record a fixture from the network")
+    parser.add_argument("--out", default="blocks.json.gz", help="fixture path for --record")
+    parser.add_argument("--blocks", type=int, default=2000, help="number of synthetic blocks")
+    parser.add_argument("--transactions", type=int, default=50, help="transactions per synthetic block")
+    parser.add_argument("--mention-rate", type=float, default=0.002)
+    parser.add_argument("--post-rate", type=float, default=0.05)
+    parser.add_argument("--metadata-size", type=int, default=4000, help="padding in synthetic post json_metadata")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--window", type=int, default=100)
+    parser.add_argument("--pipeline", action="store_true", help="also time the threaded upto_head path")
+    parser.add_argument("--baseline", help="compare against a saved result")
+    parser.add_argument("--save-baseline", help="save this result as a baseline")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="allowed throughput or peak memory regression against the baseline")
+    parser.add_argument("--verbose", action="store_true", help="show the bot's own output")
+    args = parser.parse_args()
+    with open(args.lookup) as lufil:
+        lookup = json.load(lufil)
+    if args.record:
+        record_fixture(args.out, args.record[0], args.record[1], lookup.get("nodes", silentbot2.DEFAULT_NODES))
+        return 0
+    if args.fixture:
+        start, blocks = load_fixture(args.fixture)
+    else:
+        start = 50000000
+        blocks = synthetic_blocks(lookup, args.blocks, args.transactions, args.mention_rate,
+                                  args.post_rate, args.metadata_size, args.seed)
+    with open(os.devnull, "w") as devnull:
+        output = sys.stdout if args.verbose else devnull
+        with tempfile.TemporaryDirectory() as datadir, contextlib.redirect_stdout(output):
+            os.environ["SILENTBOT_DATA_DIR"] = datadir
+            pool = OfflinePool(start, blocks, lookup)
+            result = run_stages(make_bot(args.lookup, lookup, pool), pool, args.window)
+        with tempfile.TemporaryDirectory() as datadir, contextlib.redirect_stdout(output):
+            os.environ["SILENTBOT_DATA_DIR"] = datadir
+            pool = OfflinePool(start, blocks, lookup)
+            result["peak_alloc_mb"] = measure_memory(make_bot(args.lookup, lookup, pool), pool, args.window)
+        if args.pipeline:
+            with tempfile.TemporaryDirectory() as datadir, contextlib.redirect_stdout(output):
+                os.environ["SILENTBOT_DATA_DIR"] = datadir
+                pool = OfflinePool(start, blocks, lookup)
+                result["pipeline_blocks_per_sec"] = run_pipeline(make_bot(args.lookup, lookup, pool), pool)["blocks_per_sec"]
+    print("blocks:", result["blocks"], "ops:", result["ops"], "seconds:", round(result["seconds"], 3))
+    print("blocks/sec:", int(result["blocks_per_sec"]), "ops/sec:", int(result["ops_per_sec"]),
+          "peak allocated:", round(result["peak_alloc_mb"], 1), "MB")
+    if "pipeline_blocks_per_sec" in result:
+        print("pipeline blocks/sec:", int(result["pipeline_blocks_per_sec"]))
+    for stage, seconds in sorted(result["stages"].items(), key=lambda item: -item[1]):
+        print("  %-14s %8.3fs %5.1f%%" % (stage, seconds, 100 * seconds / result["seconds"]))
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as outfil:
+            json.dump(result, outfil, indent=2)
+    if args.baseline:
+        with open(args.baseline) as infil:
+            baseline = json.load(infil)
+        if not compare(result, baseline, args.tolerance):
+            print("REGRESSION: throughput or memory more than", int(100 * args.tolerance), "% worse than baseline")
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
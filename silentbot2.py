@@ -6,15 +6,580 @@ import dateutil.parser
 import datetime
 import itertools
 import requests
-from collections import deque
+import concurrent.futures
+import multiprocessing
+import threading
+import mmap
+import struct
+import zlib
+import http.server
+import signal
+import random
+from collections import deque, OrderedDict
 import time
 import json
 import sys
 import os
 
+DEFAULT_NODES = [
+    "https://api.hive.blog",
+    "https://api.deathwing.me",
+    "https://hive-api.arcange.eu",
+    "https://api.openhive.network"
+]
+
+SKIP_APPS = ("exhaust", "3speak", "VIMM", "aureal", "actifit")
+
+def own_operation(vals, ctx):
+    if vals["author"] == ctx["account"]:
+        return True
+    return None
+
+def mentions_account(vals, ctx):
+    if not vals["parent_author"]:
+        return None
+    metadata = vals["json_metadata"]
+    # Only decode metadata that can possibly list us.
+    if metadata and ctx["account"] in metadata:
+        try:
+            cust = json.loads(metadata)
+        except json.decoder.JSONDecodeError:
+            cust = {}
+        if isinstance(cust, dict) and "users" in cust and ctx["account"] in cust["users"]:
+            return True
+    if vals["body"].startswith(ctx["mention_prefix"]):
+        return True
+    return None
+
+def top_level_post(vals, ctx):
+    metadata = vals["json_metadata"]
+    if vals["parent_author"] or not metadata:
+        return None
+    if ctx["tribe_quoted"] not in metadata and not ('"app"' in metadata and '"tags"' in metadata):
+        return None
+    try:
+        cust = json.loads(metadata)
+    except json.decoder.JSONDecodeError:
+        return None
+    if not isinstance(cust, dict):
+        return None
+    # Boil the metadata down to what the post handlers use, so a worker
+    # process only ships a few flags and the tags back.
+    tribe = ctx["tribe_quoted"] in metadata and isinstance(cust.get("tags"), list)
+    candidate = "app" in cust and "tags" in cust and not str(cust["app"]).startswith(SKIP_APPS)
+    if not tribe and not candidate:
+        return None
+    return {
+        "tags": cust["tags"],
+        "tribe": tribe,
+        "candidate": candidate,
+        "edit": vals["body"].startswith("@@ ")
+    }
+
+def extract_events(start, payload, specs, archive_upto=0):
+    # Runs in a worker process: decode a block range and evaluate the routing
+    # predicates, returning only the operations some handler wants.
+    start_time = time.time()
+    if isinstance(payload, list):
+        # Compressed blocks straight from the archive.
+        blocks = [json.loads(zlib.decompress(item)) for item in payload]
+    else:
+        blocks = json.loads(payload)["result"]["blocks"]
+    results = []
+    archived = []
+    for offset, block in enumerate(blocks):
+        if start + offset <= archive_upto:
+            archived.append(zlib.compress(json.dumps(block).encode()))
+        ts = parse_timestamp(block["timestamp"])
+        if "transactions" not in block:
+            results.append((ts, None))
+            continue
+        results.append((ts, [match_operations(block, table, ctx) for table, ctx in specs]))
+    return results, archived, time.time() - start_time
+
+def match_operations(block, table, ctx):
+    # Evaluate the routing predicates for one block, returning only the
+    # operations some handler wants.
+    events = []
+    for trans in block["transactions"]:
+        if "operations" in trans:
+            for operation in trans["operations"]:
+                # Operation types nobody registered for cost a single lookup.
+                predicates = table.get(operation["type"])
+                if predicates is None:
+                    continue
+                value = operation["value"]
+                for index, (predicate, fields) in enumerate(predicates):
+                    if predicate is None:
+                        match = True
+                    else:
+                        match = predicate(value, ctx)
+                    if match is None:
+                        continue
+                    if fields is None:
+                        events.append((operation["type"], index, value, match))
+                    else:
+                        # Only ship back what the handlers read.
+                        events.append((operation["type"], index, {field: value[field] for field in fields}, match))
+    return events
+
+class OperationRouter:
+    def __init__(self, context):
+        self.context = context
+        self.routes = {}
+        self.table = None
+
+    def register(self, op_type, handler, predicate=None, fields=None):
+        # Handlers sharing a predicate share its (possibly costly) evaluation.
+        # fields names the operation values the handler reads, None for all.
+        self.table = None
+        routes = self.routes.setdefault(op_type, [])
+        for route in routes:
+            if route[0] is predicate:
+                route[1].append(handler)
+                if route[2] is not None:
+                    route[2] = None if fields is None else tuple(sorted(set(route[2]) | set(fields)))
+                return
+        routes.append([predicate, [handler], None if fields is None else tuple(fields)])
+
+    def spec(self):
+        if self.table is None:
+            self.table = {op_type: [(route[0], route[2]) for route in routes] for op_type, routes in self.routes.items()}
+        return self.table, self.context
+
+    def apply(self, events, ts):
+        for op_type, index, vals, match in events:
+            for handler in self.routes[op_type][index][1]:
+                handler(vals, ts, match)
+
+class Metrics:
+    BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0]
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    def key(self, name, labels):
+        if labels:
+            return name, tuple(sorted(labels.items()))
+        return name, ()
+
+    def inc(self, name, labels=None, value=1):
+        key = self.key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, labels=None):
+        key = self.key(name, labels)
+        with self.lock:
+            self.gauges[key] = value
+
+    def observe(self, name, value, labels=None):
+        key = self.key(name, labels)
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = [[0] * len(self.BUCKETS), 0.0, 0]
+            histogram = self.histograms[key]
+            for index, bound in enumerate(self.BUCKETS):
+                if value <= bound:
+                    histogram[0][index] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def format(self, name, labels, extra=()):
+        labels = list(labels) + list(extra)
+        if not labels:
+            return name
+        return name + "{" + ",".join(label + '="' + str(value) + '"' for label, value in labels) + "}"
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for kind, values in (("counter", self.counters), ("gauge", self.gauges)):
+                names = set()
+                for (name, labels), value in sorted(values.items()):
+                    if name not in names:
+                        lines.append("# TYPE " + name + " " + kind)
+                        names.add(name)
+                    lines.append(self.format(name, labels) + " " + str(value))
+            names = set()
+            for (name, labels), (buckets, total, count) in sorted(self.histograms.items()):
+                if name not in names:
+                    lines.append("# TYPE " + name + " histogram")
+                    names.add(name)
+                for bound, bucket in zip(self.BUCKETS, buckets):
+                    lines.append(self.format(name + "_bucket", labels, [("le", bound)]) + " " + str(bucket))
+                lines.append(self.format(name + "_bucket", labels, [("le", "+Inf")]) + " " + str(count))
+                lines.append(self.format(name + "_sum", labels) + " " + str(total))
+                lines.append(self.format(name + "_count", labels) + " " + str(count))
+        return "\n".join(lines) + "\n"
+
+    def serve(self, host, port):
+        metrics = self
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            def log_message(self, format, *args):
+                pass
+        server = http.server.ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+METRICS = Metrics()
+
+def backoff(attempt, base=1.0, cap=120.0):
+    return min(cap, base * 2 ** attempt) * random.uniform(0.5, 1.0)
+
+def retry(action, site, deadline=None):
+    start = time.time()
+    attempt = 0
+    while True:
+        try:
+            return action()
+        except RPCNodeException as exp:
+            METRICS.inc("silentbot_retries_total", {"site": site})
+            delay = backoff(attempt)
+            if deadline is not None and time.time() + delay - start > deadline:
+                raise
+            print(site, exp)
+            time.sleep(delay)
+            attempt += 1
+
+class Scheduler:
+    def __init__(self, max_attempts=10):
+        self.max_attempts = max_attempts
+        self.tasks = {}
+
+    def defer(self, key, action, attempt=0, persistent=False):
+        self.tasks[key] = [time.time() + backoff(attempt, 5.0, 900.0), attempt, action, persistent]
+        METRICS.set("silentbot_deferred_tasks", len(self.tasks))
+
+    def attempt(self, key, action):
+        try:
+            return action()
+        except RPCNodeException as exp:
+            print("DEFERRED:", key, exp)
+            self.defer(key, action)
+
+    def run_due(self):
+        now = time.time()
+        for key, (due, attempt, action, persistent) in list(self.tasks.items()):
+            if due > now or key not in self.tasks or self.tasks[key][2] is not action:
+                continue
+            del self.tasks[key]
+            try:
+                action()
+            except RPCNodeException as exp:
+                if attempt + 1 < self.max_attempts:
+                    if key not in self.tasks:
+                        self.defer(key, action, attempt + 1, persistent)
+                elif persistent:
+                    # Curator commands are never dropped, keep trying at the slowest pace.
+                    print("STILL FAILING:", key, exp)
+                    METRICS.inc("silentbot_deferred_stuck_total")
+                    if key not in self.tasks:
+                        self.defer(key, action, attempt, persistent)
+                else:
+                    print("GIVING UP:", key, exp)
+                    METRICS.inc("silentbot_deferred_dropped_total")
+        METRICS.set("silentbot_deferred_tasks", len(self.tasks))
+
+class SamplingProfiler:
+    def __init__(self, datadir, interval=0.005):
+        self.datadir = datadir
+        self.control = os.path.join(datadir, "profile.on")
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.running = False
+        self.started_by_file = False
+        self.stacks = {}
+        self.started = 0
+
+    def install(self):
+        signal.signal(signal.SIGUSR2, lambda signum, frame: self.toggle())
+        threading.Thread(target=self.watch, daemon=True).start()
+
+    def watch(self):
+        while True:
+            wanted = os.path.exists(self.control)
+            if wanted and not self.running:
+                self.start()
+            elif not wanted and self.running and self.started_by_file:
+                self.stop()
+            time.sleep(2)
+
+    def toggle(self):
+        if self.running:
+            self.stop()
+        else:
+            self.start(False)
+
+    def start(self, by_file=True):
+        with self.lock:
+            if self.running:
+                return
+            self.running = True
+            self.started_by_file = by_file
+            self.stacks = {}
+            self.started = time.time()
+        print("PROFILER: started")
+        threading.Thread(target=self.sample, daemon=True).start()
+
+    def sample(self):
+        me = threading.get_ident()
+        while self.running:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(getattr(code, "co_qualname", code.co_name) + " (" + os.path.basename(code.co_filename) + ")")
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                key = ";".join(reversed(stack))
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+            time.sleep(self.interval)
+
+    def stop(self):
+        with self.lock:
+            if not self.running:
+                return
+            self.running = False
+        path = os.path.join(self.datadir, "profile-" + time.strftime("%Y%m%d-%H%M%S") + ".collapsed")
+        with open(path, "w") as outfil:
+            for stack, count in sorted(self.stacks.items()):
+                outfil.write(stack + " " + str(count) + "\n")
+        print("PROFILER: wrote", sum(self.stacks.values()), "samples over", int(time.time() - self.started), "seconds to", path)
+
+def parse_timestamp(value):
+    # Hive timestamps are always "YYYY-MM-DDTHH:MM:SS", fromisoformat handles
+    # those far faster than dateutil, which stays around for anything odd.
+    try:
+        return datetime.datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        return dateutil.parser.parse(value).timestamp()
+
+class ClientPool:
+    def __init__(self, nodes):
+        self.nodes = list(nodes)
+        self.latency = {node: 1.0 for node in self.nodes}
+        self.errors = {node: 0.0 for node in self.nodes}
+        self.calls = {node: 0 for node in self.nodes}
+        self.last_used = {node: 0.0 for node in self.nodes}
+        self.failures = {node: 0 for node in self.nodes}
+        self.open_until = {node: 0.0 for node in self.nodes}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def score(self, node, now):
+        # A node that misbehaved gets another chance once it has been idle for a while.
+        errors = self.errors[node] * 0.5 ** ((now - self.last_used[node]) / 300)
+        return self.latency[node] * (1 + 20 * errors)
+
+    def ranked(self):
+        now = time.time()
+        with self.lock:
+            nodes = [node for node in self.nodes if self.open_until[node] <= now]
+            if not nodes:
+                nodes = self.nodes
+            return sorted(nodes, key=lambda node: self.score(node, now))
+
+    def available(self, node):
+        return self.open_until[node] <= time.time()
+
+    def best(self):
+        nodes = self.ranked()
+        # Retries from this thread go to another node than the one that just failed.
+        if len(nodes) > 1 and nodes[0] == getattr(self.local, "failed", None):
+            return nodes[1]
+        return nodes[0]
+
+    def record(self, node, elapsed, error):
+        with self.lock:
+            self.calls[node] += 1
+            self.last_used[node] = time.time()
+            if elapsed is not None:
+                self.latency[node] = 0.8 * self.latency[node] + 0.2 * elapsed
+            self.errors[node] = 0.8 * self.errors[node] + (0.2 if error else 0.0)
+            if error:
+                self.failures[node] += 1
+                if self.failures[node] >= 3:
+                    # Trip the breaker, a half-open trial call is allowed once it expires.
+                    self.open_until[node] = time.time() + min(600, 30 * 2 ** (self.failures[node] - 3))
+                    print("CIRCUIT OPEN:", node, self.failures[node], "consecutive failures")
+                    METRICS.inc("silentbot_circuit_open_total", {"node": node})
+            else:
+                self.failures[node] = 0
+
+    def client(self, node, wif=None):
+        if not hasattr(self.local, "clients"):
+            self.local.clients = {}
+        if isinstance(wif, list):
+            wif = tuple(wif)
+        key = (node, wif)
+        if key not in self.local.clients:
+            if wif is None:
+                self.local.clients[key] = Client(nodes=[node])
+            elif isinstance(wif, tuple):
+                self.local.clients[key] = Client(nodes=[node], keys=list(wif))
+            else:
+                self.local.clients[key] = Client(nodes=[node], keys=[wif])
+        return self.local.clients[key]
+
+    def run(self, method, action, node=None, wif=None):
+        if node is None:
+            node = self.best()
+        client = self.client(node, wif)
+        labels = {"method": method, "node": node}
+        start = time.time()
+        try:
+            rval = action(client)
+        except RPCNodeException:
+            METRICS.inc("silentbot_rpc_calls_total", dict(labels, result="rpc_error"))
+            if method == "broadcast":
+                # The node did answer, it just didn't like the transaction.
+                self.record(node, time.time() - start, False)
+            else:
+                # A read should never fail ("Internal Error", database lock...), so
+                # treat it as the node's fault. Error replies come back fast, keep
+                # them out of the latency average.
+                self.record(node, None, True)
+                self.local.failed = node
+            raise
+        except Exception as exp:
+            self.record(node, time.time() - start, True)
+            self.local.failed = node
+            METRICS.inc("silentbot_rpc_calls_total", dict(labels, result="node_error"))
+            raise RPCNodeException(node + ": " + str(exp))
+        elapsed = time.time() - start
+        self.record(node, elapsed, False)
+        if getattr(self.local, "failed", None) == node:
+            self.local.failed = None
+        METRICS.inc("silentbot_rpc_calls_total", dict(labels, result="ok"))
+        METRICS.observe("silentbot_rpc_seconds", elapsed, labels)
+        return rval
+
+    def call(self, method, *args, api="condenser_api", node=None):
+        return self.run(method, lambda client: getattr(client(api), method)(*args), node)
+
+    def call_raw(self, method, params, api="condenser_api", node=None):
+        # Undecoded response text, so decoding can happen in another process.
+        if node is None:
+            node = self.best()
+        request = {"jsonrpc": "2.0", "method": api + "." + method, "params": params, "id": 1}
+        def action(client):
+            if not hasattr(self.local, "session"):
+                self.local.session = requests.Session()
+            text = self.local.session.post(node, json=request, timeout=30).text
+            if '"result"' not in text[:64]:
+                raise RPCNodeException(str(json.loads(text).get("error", text[:200])))
+            return text
+        return self.run(method, action, node)
+
+    def vp(self, account):
+        return self.run("vp", lambda client: client("condenser_api").account(account).vp())
+
+    def broadcast(self, op, wif):
+        return self.run("broadcast", lambda client: client("condenser_api").broadcast(op), wif=wif)
+
+class StateJournal:
+    def __init__(self, bupath, compact_every=20000):
+        self.bupath = bupath
+        self.jpath = os.path.splitext(bupath)[0] + ".journal"
+        self.compact_every = compact_every
+        self.records = []
+        self.seq = 0
+        self.size = 0
+        self.block = None
+        self.jfile = None
+
+    def log(self, *record):
+        self.records.append(list(record))
+
+    def load(self):
+        try:
+            with open(self.bupath) as infil:
+                obj = json.load(infil)
+        except FileNotFoundError:
+            return None, []
+        self.seq = obj.get("seq", 0)
+        self.block = obj.get("block")
+        entries = []
+        try:
+            with open(self.jpath) as infil:
+                for line in infil:
+                    try:
+                        entry = json.loads(line)
+                    except json.decoder.JSONDecodeError:
+                        # Torn write from a crash, nothing after it was committed.
+                        break
+                    if entry["seq"] > self.seq:
+                        entries.append(entry)
+                        self.block = entry["block"]
+                        self.seq = entry["seq"]
+        except FileNotFoundError:
+            pass
+        return obj, entries
+
+    def commit(self, block):
+        self.seq += 1
+        line = json.dumps({"seq": self.seq, "block": block, "ops": self.records})
+        if self.jfile is None:
+            self.jfile = open(self.jpath, "a")
+        self.jfile.write(line + "\n")
+        self.jfile.flush()
+        os.fsync(self.jfile.fileno())
+        self.size += len(self.records) + 1
+        self.records = []
+        self.block = block
+
+    def flush(self):
+        # Make the records so far durable without moving the cursor past the
+        # batch in progress; a crash replays that batch from the last cursor.
+        if self.block is not None and self.records:
+            self.commit(self.block)
+
+    def needs_compaction(self):
+        return self.size > self.compact_every
+
+    def snapshot(self, obj):
+        obj["seq"] = self.seq
+        self.block = obj.get("block")
+        tmppath = self.bupath + ".tmp"
+        with open(tmppath, "w") as outfil:
+            json.dump(obj, outfil)
+            outfil.flush()
+            os.fsync(outfil.fileno())
+        os.replace(tmppath, self.bupath)
+        # The snapshot covers everything up to seq, so the journal can start over.
+        if self.jfile is not None:
+            self.jfile.close()
+        self.jfile = open(self.jpath, "w")
+        os.fsync(self.jfile.fileno())
+        dirfd = os.open(os.path.dirname(os.path.abspath(self.bupath)), os.O_RDONLY)
+        try:
+            os.fsync(dirfd)
+        finally:
+            os.close(dirfd)
+        self.records = []
+        self.size = 0
+
 class TokenStake:
-    def __init__(self, tokens, accounts):
+    def __init__(self, tokens, accounts, pool, session=None):
         self.tokens = tokens
+        self.pool = pool
         self.accounts = accounts
         self.stake = {}
         for account in self.accounts:
@@ -25,6 +590,8 @@ class TokenStake:
         self.last_sync = 0
         self.id = 0
         self.url = "https://api.hive-engine.com/rpc/contracts"
+        self.session = session or requests.Session()
+        self.limit = 1000
         self.json = {
                 "jsonrpc": "2.0",
                 "id": None,
@@ -33,33 +600,50 @@ class TokenStake:
                     "contract": "tokens",
                     "table": "balances",
                     "query": {
-                       "account":None,
-                       "symbol": None
+                       "account": {"$in": self.accounts},
+                       "symbol": {"$in": self.tokens}
                     },
-                    "limit": 1,
+                    "limit": self.limit,
                     "offset": 0,
                     "indexes":[]
                 }
             }
-        self.sync()
+        self.interval = 3500
+        self.worker = threading.Thread(target=self.refresh_loop, daemon=True)
+        self.worker.start()
+    def refresh_loop(self):
+        while True:
+            if self.sync():
+                time.sleep(self.interval)
+            else:
+                time.sleep(60)
     def sync(self):
-        for account in self.accounts:
-            for token in self.tokens:
-                self.json["params"]["query"]["account"] = account
-                self.json["params"]["query"]["symbol"] = token
-                self.json["id"] = self.id
-                self.id += 1
-                try:
-                    with requests.post(self.url, json=self.json) as r:
-                        data = r.json()
-                except:
-                    print("Error fetching data from hive-engine")
-                    return
-                if data['result'] and "stake" in data['result'][0]:
-                    self.stake[account][token] = (float(data['result'][0]["stake"]) +
-                                                  float(data['result'][0]["delegationsIn"]))
+        # Fill a copy and only publish it once every source answered, so readers
+        # never see a half refreshed or zeroed table.
+        stake = {account: dict(self.stake[account]) for account in self.accounts}
+        offset = 0
+        while True:
+            self.json["params"]["offset"] = offset
+            self.json["id"] = self.id
+            self.id += 1
+            try:
+                with self.session.post(self.url, json=self.json) as r:
+                    data = r.json()
+            except:
+                print("Error fetching data from hive-engine")
+                return False
+            result = data.get("result") or []
+            for row in result:
+                if (row.get("account") in stake and
+                        row.get("symbol") in self.tokens and
+                        "stake" in row):
+                    stake[row["account"]][row["symbol"]] = (float(row["stake"]) +
+                                                            float(row["delegationsIn"]))
+            if len(result) < self.limit:
+                break
+            offset += self.limit
         try:
-            props = Client().get_dynamic_global_properties()
+            props = self.pool.call("get_dynamic_global_properties")
             ratio = float(props["total_vesting_shares"].split(" ")[0])/float(props["total_vesting_fund_hive"].split(" ")[0])
             for entry in  [
                     [
@@ -68,27 +652,128 @@ class TokenStake:
                             float(val["delegated_vesting_shares"].split(" ")[0]) +
                             float(val["received_vesting_shares"].split(" ")[0])
                         )/ratio
-                    ] for val in Client().get_accounts(self.accounts)
+                    ] for val in self.pool.call("get_accounts", self.accounts)
                 ]:
-                self.stake[entry[0]]["HIVE"] = entry[1]
-        except RPCNodeException:
-            return
+                stake[entry[0]]["HIVE"] = entry[1]
+        except RPCNodeException as exp:
+            print("Error fetching HIVE stake:", exp)
+            return False
+        self.stake = stake
         self.last_sync = time.time()
+        return True
+    def age(self):
+        if self.last_sync == 0:
+            return None
+        return time.time() - self.last_sync
     def __getitem__(self, account):
-        if time.time() - self.last_sync > 3500:
-            self.sync()
         return self.stake[account]
 
+class SocialGraph:
+    KINDS = ["blacklist", "following", "subscriptions"]
+
+    def __init__(self, accounts, pool, path, interval=3600):
+        self.accounts = list(dict.fromkeys(accounts))
+        self.pool = pool
+        self.path = path
+        self.interval = interval
+        self.graph = {}
+        self.fetched = {}
+        self.listeners = []
+        self.lock = threading.Lock()
+        self.load()
+        missing = [account for account in self.accounts if account not in self.graph]
+        if missing:
+            print("Loading social graph for", len(missing), "accounts")
+            self.sync(missing, True)
+
+    def load(self):
+        try:
+            with open(self.path) as infil:
+                obj = json.load(infil)
+        except (FileNotFoundError, json.decoder.JSONDecodeError):
+            return
+        for account, entry in obj.get("accounts", {}).items():
+            if account in self.accounts:
+                self.graph[account] = {kind: set(entry[kind]) for kind in self.KINDS}
+                self.fetched[account] = entry["time"]
+
+    def save(self):
+        with self.lock:
+            obj = {"accounts": {account: dict({kind: sorted(self.graph[account][kind]) for kind in self.KINDS},
+                                              time=self.fetched[account])
+                                for account in self.graph}}
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as outfil:
+            json.dump(obj, outfil)
+        os.replace(tmp, self.path)
+
+    def fetch(self, account, kind):
+        if kind == "blacklist":
+            return {item["name"] for item in self.pool.call("get_follow_list", {"observer":account, "follow_type":"blacklisted"}, api="bridge")}
+        if kind == "following":
+            return {item["following"] for item in self.pool.call("get_following", account)}
+        return {item[0] for item in self.pool.call("list_all_subscriptions", {"account":account}, api="bridge")}
+
+    def sync(self, accounts, block=False):
+        # All lists of all accounts are requested at once; an account is only
+        # updated when all three of its lists came back.
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(16, 3 * len(accounts))) as executor:
+            futures = {}
+            for account in accounts:
+                for kind in self.KINDS:
+                    if block:
+                        futures[(account, kind)] = executor.submit(retry, lambda account=account, kind=kind: self.fetch(account, kind), "SocialGraph." + kind)
+                    else:
+                        futures[(account, kind)] = executor.submit(self.fetch, account, kind)
+            complete = True
+            for account in accounts:
+                try:
+                    entry = {kind: futures[(account, kind)].result() for kind in self.KINDS}
+                except RPCNodeException as exp:
+                    print("Error refreshing social graph of", account, exp)
+                    complete = False
+                    continue
+                with self.lock:
+                    self.graph[account] = entry
+                    self.fetched[account] = time.time()
+        self.save()
+        for listener in self.listeners:
+            listener()
+        return complete
+
+    def start(self):
+        self.worker = threading.Thread(target=self.refresh_loop, daemon=True)
+        self.worker.start()
+
+    def refresh_loop(self):
+        while True:
+            now = time.time()
+            stale = [account for account in self.accounts if now - self.fetched[account] >= self.interval]
+            if stale and not self.sync(stale):
+                time.sleep(60)
+                continue
+            time.sleep(max(60, min(self.fetched.values()) + self.interval - time.time()))
+
+    def lists(self, account):
+        entry = self.graph[account]
+        return entry["blacklist"], entry["following"], entry["subscriptions"]
+
 class Reporter:
-    def __init__(self, account, wif, tribe, ts):
+    def __init__(self, account, wif, tribe, ts, pool, journal, scheduler):
         self.account = account
         self.wif = wif
+        self.pool = pool
+        self.journal = journal
+        self.scheduler = scheduler
         self.tribe = tribe
         self.ts = ts
         now = datetime.datetime.utcnow()
         self.today = now.date().isoformat()
         self.hour = now.hour
+        # Running aggregates only: star -> count, account -> [count, total percentage].
         self.ratings = {}
+        self.top = {}
+        self.top_limit = 50
         self.votes = {}
         self.jicvotes = {}
         self.status = {}
@@ -99,10 +784,12 @@ class Reporter:
             self.flush()
             self.today = now.date().isoformat()
             self.hour = now.hour
+            self.journal.log("day", self.today, self.hour)
         elif self.hour != now.hour:
             #if (now.hour % 6) == 0:
             self.report()
             self.hour = now.hour
+            self.journal.log("day", self.today, self.hour)
     def report(self):
         users = set()
         now = datetime.datetime.utcnow().time().isoformat().split(".")[0]
@@ -113,10 +800,7 @@ class Reporter:
 
 """
         for stars in ["5","4","3","2","1"]:
-            if stars in self.ratings:
-                markdown += "* " + stars + " stars : " + str(len(self.ratings[stars])) + "\n"
-            else:
-                markdown += "* " + stars + " stars : 0\n"
+            markdown += "* " + stars + " stars : " + str(self.ratings.get(stars, 0)) + "\n"
         markdown += """
 
 ## Top-star rated posts
@@ -125,10 +809,12 @@ class Reporter:
 | --- | ---  | --- | --- |
 """
         for stars in ["5","4"]:
-            if stars in self.ratings:
-                for rating in self.ratings[stars]:
+            if stars in self.top:
+                for rating in self.top[stars]:
                     markdown += "| " + stars + " | @" + rating[0] + " | [" + rating[1] + "](/@" + rating[0] + "/" + rating[1] + ") | @" + rating[2] + " |\n"
                     users.add(rating[0])
+                if self.ratings[stars] > len(self.top[stars]):
+                    markdown += "| " + stars + " | " + str(self.ratings[stars] - len(self.top[stars])) + " more | | |\n"
         markdown += """
 
 ## Voting status
@@ -138,9 +824,7 @@ class Reporter:
 """
         for account in self.votes:
             users.add(account)
-            total = 0.0
-            for vote in self.votes[account]:
-                total += vote[2]
+            total = self.votes[account][1]
             percentage = str(int(240*total/(1+self.hour))/100)
             ts = self.ts[account]
             markdown += "| @" + account + " | " + percentage + "% | " + str(int(ts["CCC"])) + " | " + str(int(ts["HIVE"])) + " | " + str(int(ts["WIT"])) +" |\n"
@@ -152,12 +836,15 @@ class Reporter:
 | --- | --- | --- | --- | --- |
 """
         for account in self.jicvotes:
-            total = 0.0
-            for vote in self.jicvotes[account]:
-                total += vote[2]
+            total = self.jicvotes[account][1]
             percentage = str(int(100*total*2.4/(1+self.hour))/100)
             ts = self.ts[account]
             markdown += "| @" + account + " | " + percentage + "% | " + str(int(ts["CCC"])) + " | " + str(int(ts["HIVE"])) + " | " + str(int(ts["WIT"])) + " |\n"
+        stake_age = self.ts.age()
+        if stake_age is None:
+            markdown += "\nStake figures are not available yet.\n"
+        else:
+            markdown += "\nStake figures are " + str(int(stake_age/60)) + " minutes old.\n"
         markdown += """
 ## Voting backlog 
 
@@ -192,40 +879,47 @@ class Reporter:
                         "image": []
                         })
                 })
-        resp = None
-        while resp is None:
-            try:
-                resp = Client(keys=[self.wif]).broadcast(my_post)
-            except RPCNodeException as exp:
-                print(exp)
-                time.sleep(5)
+        # A newer report for the same day replaces any still pending one.
+        self.scheduler.attempt("report:" + permlink, lambda: self.pool.broadcast(my_post, self.wif))
     def flush(self):
         self.ratings = {}
+        self.top = {}
         self.votes = {}
         self.jicvotes = {}
+        self.journal.log("flush")
+    def add_rating(self, ststar, rating):
+        self.ratings[ststar] = self.ratings.get(ststar, 0) + 1
+        if ststar in ("5", "4"):
+            top = self.top.setdefault(ststar, [])
+            if len(top) < self.top_limit:
+                top.append(rating)
+    def add_vote(self, votes, account, percentage):
+        if account not in votes:
+            votes[account] = [0, 0.0]
+        votes[account][0] += 1
+        votes[account][1] += percentage
     def rate(self, curator, user, permlink, stars):
         print("REPORTER:RATE", curator, user, permlink, stars)
         ststar = str(stars)
-        if ststar not in self.ratings:
-            self.ratings[ststar] = []
-        self.ratings[ststar].append([user, permlink, curator])
+        self.add_rating(ststar, [user, permlink, curator])
+        self.journal.log("rate", ststar, [user, permlink, curator])
     def vote(self, account, user, permlink, percentage):
         print("REPORTER:VOTE", account, user, permlink, percentage)
-        if account not in self.votes:
-            self.votes[account] = []
-        self.votes[account].append([user, permlink, percentage])
+        self.add_vote(self.votes, account, percentage)
+        self.journal.log("vote", account, [user, permlink, percentage])
     def jicvote(self, account, user, permlink, percentage):
         print("REPORTER:JICVOTE", account, user, permlink, percentage)
-        if account not in self.jicvotes:
-            self.jicvotes[account] = []
-        self.jicvotes[account].append([user, permlink, percentage])
+        self.add_vote(self.jicvotes, account, percentage)
+        self.journal.log("jicvote", account, [user, permlink, percentage])
     def vote_status(self, account, strength, weight, count):
+        # Recomputed every vote tick, so only the snapshot carries it.
         self.status[account] = [time.time(), strength, weight, count]
     def backup(self):
         obj = {}
         obj["today"] = self.today
         obj["hour"] = self.hour
         obj["ratings"] = self.ratings
+        obj["top"] = self.top
         obj["votes"] = self.votes
         obj["jic"]= self.jicvotes
         obj["status"] = self.status
@@ -234,167 +928,521 @@ class Reporter:
         if isinstance(obj, dict):
             self.today = obj["today"]
             self.hour = obj["hour"]
-            self.ratings = obj["ratings"]
-            self.votes = obj["votes"]
-            self.jicvotes = obj["jic"]
             self.status = obj["status"]
+            if "top" in obj:
+                self.ratings = obj["ratings"]
+                self.top = obj["top"]
+                self.votes = obj["votes"]
+                self.jicvotes = obj["jic"]
+            else:
+                # Older backups kept every event, fold them into aggregates.
+                self.ratings = {}
+                self.top = {}
+                for ststar, ratings in obj["ratings"].items():
+                    for rating in ratings:
+                        self.add_rating(ststar, rating)
+                self.votes = {}
+                self.jicvotes = {}
+                for votes, old in [(self.votes, obj["votes"]), (self.jicvotes, obj["jic"])]:
+                    for account, entries in old.items():
+                        for vote in entries:
+                            self.add_vote(votes, account, vote[2])
+    def replay(self, record):
+        if record[0] == "day":
+            self.today = record[1]
+            self.hour = record[2]
+        elif record[0] == "flush":
+            self.ratings = {}
+            self.top = {}
+            self.votes = {}
+            self.jicvotes = {}
+        elif record[0] == "rate":
+            self.add_rating(record[1], record[2])
+        elif record[0] == "vote":
+            self.add_vote(self.votes, record[1], record[2][2])
+        elif record[0] == "jicvote":
+            self.add_vote(self.jicvotes, record[1], record[2][2])
+        elif record[0] == "status":
+            self.status[record[1]] = record[2]
+
+
+
+class VoteEntry:
+    __slots__ = ("weight", "author", "permlink", "ts")
+
+    def __init__(self, weight, author, permlink, ts):
+        self.weight = weight
+        self.author = author
+        self.permlink = permlink
+        self.ts = ts
+
+    def as_list(self):
+        return [self.weight, self.author, self.permlink, self.ts]
+
+    def __repr__(self):
+        return repr(self.as_list())
+
+class VoteQueue:
+    def __init__(self, entries=(), journal=None, key=None):
+        self.entries = deque()
+        self.total = 0
+        self.positive = 0
+        self.version = 0
+        self.journal = None
+        for entry in entries:
+            self.append(VoteEntry(*entry))
+        self.journal = journal
+        self.key = key
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def head(self):
+        return self.entries[0]
+
+    def append(self, entry):
+        self.entries.append(entry)
+        self.version += 1
+        self.total += entry.weight
+        if entry.weight > 0:
+            self.positive += entry.weight
+        if self.journal is not None:
+            self.journal.log("push", self.key, entry.as_list())
+
+    def popleft(self):
+        entry = self.entries.popleft()
+        self.version += 1
+        self.total -= entry.weight
+        if entry.weight > 0:
+            self.positive -= entry.weight
+        if self.journal is not None:
+            self.journal.log("pop", self.key)
+        return entry
+
+    def remove(self, entry):
+        if entry is self.entries[0]:
+            return self.popleft()
+        self.entries.remove(entry)
+        self.version += 1
+        self.total -= entry.weight
+        if entry.weight > 0:
+            self.positive -= entry.weight
+        if self.journal is not None:
+            self.journal.log("remove", self.key, entry.as_list())
+        return entry
+
+    def find(self, values):
+        for entry in self.entries:
+            if entry.as_list() == values:
+                return entry
+        return None
+
+    def backup(self):
+        return [entry.as_list() for entry in self.entries]
+
+class PendingVote:
+    __slots__ = ("voter", "queue", "entry", "weight", "vp")
+
+    def __init__(self, voter, queue, entry, weight, vp):
+        self.voter = voter
+        self.queue = queue
+        self.entry = entry
+        self.weight = weight
+        self.vp = vp
+
+    def operation(self):
+        return Operation('vote', {
+            "voter": self.voter.account,
+            "author": self.entry.author,
+            "permlink": self.entry.permlink,
+            "weight": self.weight,
+        })
+
+class VotePlanner:
+    PAYOUT = 7*86400
 
+    def __init__(self, vp_floor=0.0, spacing=3):
+        self.vp_floor = vp_floor
+        self.spacing = spacing
 
+    def attenuation(self, queue, vp):
+        total_queue_weight = queue.positive/100
+        effective_backlog_time = (100 + total_queue_weight/50 - vp) * 4320
+        if effective_backlog_time < 86400:
+            return 1.0
+        return max(0.1, 1-(effective_backlog_time - 86400)/576000)
+
+    def plan(self, voter, now):
+        # Simulate voting power forward and give every queued vote the earliest
+        # slot at which it can be cast at full strength without dropping below
+        # the floor. Of the votes that can go at a given moment the most urgent
+        # (closest to payout) goes first, one that has to wait for voting power
+        # doesn't hold back the ones behind it. Downvotes come out of their own
+        # mana pool and are never held back by upvote voting power.
+        vp = voter.voting_power()
+        if len(voter.vote_queue) > 0:
+            queue = voter.vote_queue
+            attenuation = self.attenuation(queue, vp)
+            if attenuation < 1.0:
+                print(voter.account, "Attenuate votes to:", attenuation)
+        else:
+            queue = voter.just_in_case
+            attenuation = 1.0
+        when = max(now, voter.last_vote + self.spacing, voter.hold_until)
+        level = min(100.0, vp + (when - now)/4320)
+        remaining = []
+        for entry in sorted(queue, key=lambda entry: entry.ts):
+            if entry.ts + self.PAYOUT <= now:
+                queue.remove(entry)
+                print(voter.account, "dropping vote target past payout", entry.as_list()[:2])
+                continue
+            remaining.append(entry)
+        schedule = []
+        while remaining:
+            pick = None
+            wait = None
+            for entry in remaining:
+                if entry.weight < 0:
+                    pick = entry
+                    break
+                required = self.required(entry.weight * attenuation)
+                if level >= required:
+                    pick = entry
+                    break
+                if wait is None or required < wait[0]:
+                    wait = (required, entry)
+            if pick is None:
+                required, pick = wait
+                when += (required - level) * 4320
+                level = required
+            remaining.remove(pick)
+            if when >= pick.ts + self.PAYOUT:
+                continue
+            if pick.weight > 0:
+                schedule.append((when, queue, pick, attenuation))
+                level -= pick.weight * attenuation / 5000
+            else:
+                schedule.append((when, queue, pick, 1.0))
+            when += self.spacing
+            level = min(100.0, level + self.spacing/4320)
+        return schedule
+
+    def required(self, needed):
+        return min(100.0, max(needed / 100, self.vp_floor + needed / 5000))
 
 class Voter:
-    def __init__(self, account, wif, reporter):
+    def __init__(self, account, wif, reporter, pool, journal, index, social, planner):
         self.account = account
         self.wif = wif
         self.reporter = reporter
-        self.blacklist = None
-        while self.blacklist is None:
-            try:
-                self.blacklist = {item["name"] for item in Client()("bridge").get_follow_list({"observer":account, "follow_type":"blacklisted"})}
-            except RPCNodeException as exp:
-                print(exp)
-                time.sleep(5)
-        self.following = None
-        while self.following is None:
-            try:
-                self.following = {item["following"] for item in Client().get_following(account)}
-            except RPCNodeException as exp:
-                print(exp)
-                time.sleep(5)
-        self.subscriptions = None
-        while self.subscriptions is None:
+        self.pool = pool
+        self.journal = journal
+        self.index = index
+        self.blacklist, self.following, self.subscriptions = social.lists(account)
+        self.vote_queue = VoteQueue([], journal, [index, "main", account])
+        self.just_in_case = VoteQueue([], journal, [index, "jic", account])
+        self.last_vote = 0
+        self.hold_until = 0
+        self.planner = planner
+        self.schedule = None
+        self.schedule_version = None
+        self.vp_value = None
+        self.vp_time = 0
+        self.vp_synced = 0
+        self.vp_resync = 3600
+
+    def voting_power(self):
+        now = time.time()
+        if self.vp_value is None or now - self.vp_synced > self.vp_resync:
             try:
-                self.subscriptions = {item[0] for item in Client()("bridge").list_all_subscriptions({"account":account})}
+                vp = self.pool.vp(self.account)
             except RPCNodeException as exp:
-                print(exp)
-                time.sleep(5)
-        self.vote_queue = deque()
-        self.just_in_case = deque()
-        self.last_vote = 0
+                METRICS.inc("silentbot_retries_total", {"site": "Voter.voting_power"})
+                if self.vp_value is None:
+                    raise
+                # Keep using the model and try the node again in a minute.
+                print(self.account, "VP SYNC ERROR:", exp)
+                self.vp_synced = now - self.vp_resync + 60
+            else:
+                self.vp_value = vp
+                self.vp_time = now
+                self.vp_synced = now
+                self.schedule = None
+        # Voting power regenerates 1% every 4320 seconds, capped at 100%.
+        return min(100.0, self.vp_value + (now - self.vp_time)/4320)
+
+    def spend_voting_power(self, weight):
+        if weight <= 0:
+            # Since HF21 downvotes come out of a separate downvote mana pool.
+            return
+        vp = self.voting_power()
+        # A 100% vote uses 2% of the current voting mana.
+        self.vp_value = vp - vp * weight / 500000
+        self.vp_time = time.time()
     def backup(self):
         obj = {}
-        obj["main"] = list(self.vote_queue)
-        obj["jic"] = list(self.just_in_case)
+        obj["main"] = self.vote_queue.backup()
+        obj["jic"] = self.just_in_case.backup()
         return obj
     def restore(self, obj):
-        self.vote_queue = deque(obj["main"])
-        self.just_in_case = deque(obj["jic"])
-    def candidate_just_in_case(self, author, permlink, tags, ts):
-        candidate = False
-        if author in self.following:
-            candidate = True
-        for tag in tags:
-            if tag in self.subscriptions:
-                candidate = True
-        if author in self.blacklist:
-            candidate = False
-        if candidate:
-            self.just_in_case.append([9950, author, permlink, ts])
-
-    def vote_if_needed(self):
-        now = time.time()
-        while len(self.vote_queue) > 0 and now - self.vote_queue[0][3] > 6*122400:
+        self.vote_queue = VoteQueue(obj["main"], self.journal, [self.index, "main", self.account])
+        self.just_in_case = VoteQueue(obj["jic"], self.journal, [self.index, "jic", self.account])
+    def replay(self, record):
+        if record[1][1] == "main":
+            queue = self.vote_queue
+        else:
+            queue = self.just_in_case
+        if record[0] == "push":
+            queue.append(VoteEntry(*record[2]))
+        elif record[0] == "remove":
+            entry = queue.find(record[2])
+            if entry is not None:
+                queue.remove(entry)
+        else:
+            queue.popleft()
+
+    def add_just_in_case(self, author, permlink, ts):
+        # Blocks may be replayed after a crash, don't queue the same post twice.
+        for entry in self.just_in_case:
+            if entry.permlink == permlink and entry.author == author:
+                return
+        self.just_in_case.append(VoteEntry(9950, author, permlink, ts))
+
+    def expire(self, now):
+        while len(self.vote_queue) > 0 and now - self.vote_queue.head().ts > 6*122400:
             candidate = self.vote_queue.popleft()
-            print(self.account, "dropping stale vote target, more than 6 days old", candidate[:2])
-        while len(self.just_in_case) > 0 and now - self.just_in_case[0][3] > 122400:
+            print(self.account, "dropping stale vote target, more than 6 days old", candidate.as_list()[:2])
+        while len(self.just_in_case) > 0 and now - self.just_in_case.head().ts > 122400:
             candidate = self.just_in_case.popleft()
-            print(self.account, "dropping stale just_in_case candidate, more than 1 days old", candidate[:2])
+            print(self.account, "dropping stale just_in_case candidate, more than 1 days old", candidate.as_list()[:2])
         while len(self.just_in_case) > 32:
             candidate = self.just_in_case.popleft()
-        if now - self.last_vote > 120 and len(self.vote_queue) > 0:
-            vp = None
-            while vp is None:
-                try:
-                    vp = Client().account(self.account).vp()
-                except RPCNodeException as exp:
-                    print(exp)
-                    time.sleep(5)
-            total_queue_weight = sum([entry[0] for entry in self.vote_queue if entry[0] > 0])/100
-            effective_backlog_time = (100 + total_queue_weight/50 - vp) * 4320
-            needed = self.vote_queue[0][0]
-            if effective_backlog_time < 86400 or needed <= 0:
-                attenuation = 1.0
-            else:
-                attenuation = 1-(effective_backlog_time - 86400)/576000
-                print("Attenuate votes to:", attenuation)
-            adjusted = int(needed * 100 * attenuation / vp)
-            if adjusted <= 10000:
-                op = Operation('vote', {
-                    "voter": self.account,
-                    "author": self.vote_queue[0][1],
-                    "permlink": self.vote_queue[0][2],
-                    "weight": adjusted,
-                })
-                try:
-                    resp = Client(keys=[self.wif]).broadcast(op)
-                    voted_for = self.vote_queue.popleft()
-                    print(self.account,"VOTE", vp, adjusted, voted_for)
-                    self.reporter.vote(self.account, voted_for[1], voted_for[2], voted_for[0]/100)
-                except RPCNodeException as exp:
-                    print(self.account,"VOTE ERROR",exp)
-                    if "identical" in str(exp):
-                        self.vote_queue.popleft()
-                        print(self.account,"IDENTICAL")
-                    else:
-                        print(self.account,"VOTE ERROR:", exp)
-                self.last_vote = time.time()
-        if now - self.last_vote > 120 and len(self.vote_queue) == 0 and  len(self.just_in_case) > 0:
-            vp = None
-            while vp is None:
-                try:
-                    vp = Client().account(self.account).vp()
-                except RPCNodeException as exp:
-                    print(exp)
-                    time.sleep(5)
-            needed = self.just_in_case[0][0]
-            adjusted = int(needed * 100 / vp)
-            if adjusted <= 10000:
-                op = Operation('vote', {
-                    "voter": self.account,
-                    "author": self.just_in_case[0][1],
-                    "permlink": self.just_in_case[0][2],
-                    "weight": adjusted,
-                })
-                client = Client(keys=[self.wif])
-                try:
-                    resp = client.broadcast(op)
-                    voted_for = self.just_in_case.popleft()
-                    print(self.account,"VOTE", vp, adjusted, voted_for)
-                    self.reporter.jicvote(self.account, voted_for[1], voted_for[2], voted_for[0]/100)
-                except RPCNodeException as exp:
-                    if "identical" in str(exp):
-                        self.just_in_case.popleft()
-                        print(self.account, "VOTE ERROR: IDENTICAL")
-                    else:
-                        print("VOTE ERROR:", str(exp))
-                self.last_vote = time.time()
-        vp = None
-        while vp is None:
-            try:
-                vp = Client().account(self.account).vp()
-            except RPCNodeException as exp:
-                print(exp)
-                time.sleep(5)
+
+    def next_vote(self, now):
+        if len(self.vote_queue) == 0 and len(self.just_in_case) == 0:
+            return None
+        version = (self.vote_queue.version, self.just_in_case.version)
+        if self.schedule is None or self.schedule_version != version:
+            self.schedule = self.planner.plan(self, now)
+            self.schedule_version = (self.vote_queue.version, self.just_in_case.version)
+            if self.schedule:
+                METRICS.set("silentbot_vote_schedule_seconds", self.schedule[-1][0] - now, {"voter": self.account, "index": self.index})
+        if not self.schedule or self.schedule[0][0] > now:
+            return None
+        at, queue, entry, factor = self.schedule[0]
+        vp = self.voting_power()
+        if entry.weight < 0:
+            # Downvotes use their own mana, cast them as queued.
+            adjusted = max(-10000, int(entry.weight))
+        else:
+            adjusted = int(entry.weight * 100 * factor / vp)
+        if abs(adjusted) > 10000:
+            # The model drifted from the chain, plan again from the real figure.
+            self.schedule = None
+            return None
+        return PendingVote(self, queue, entry, adjusted, vp)
+
+    def vote_cast(self, vote):
+        voted_for = vote.queue.remove(vote.entry)
+        self.spend_voting_power(vote.weight)
+        print(self.account,"VOTE", vote.vp, vote.weight, voted_for)
+        if vote.queue is self.vote_queue:
+            self.reporter.vote(self.account, voted_for.author, voted_for.permlink, voted_for.weight/100)
+        else:
+            self.reporter.jicvote(self.account, voted_for.author, voted_for.permlink, voted_for.weight/100)
+        self.last_vote = time.time()
+        if self.schedule and self.schedule[0][2] is voted_for:
+            # The rest of the plan still holds, the version bump is ours.
+            self.schedule.pop(0)
+            self.schedule_version = (self.vote_queue.version, self.just_in_case.version)
+
+    def vote_failed(self, vote, exp):
+        self.vp_synced = 0
+        self.schedule = None
+        if "identical" in str(exp):
+            vote.queue.remove(vote.entry)
+            print(self.account, "VOTE ERROR: IDENTICAL")
+        else:
+            print(self.account, "VOTE ERROR:", exp)
+            self.hold_until = time.time() + 120
+        self.last_vote = time.time()
+
+    def report_status(self):
+        vp = self.voting_power()
+        labels = {"voter": self.account, "index": self.index}
+        METRICS.set("silentbot_vote_queue_depth", len(self.vote_queue), labels)
+        METRICS.set("silentbot_vote_queue_weight", self.vote_queue.positive/100, labels)
+        METRICS.set("silentbot_jic_queue_depth", len(self.just_in_case), labels)
+        METRICS.set("silentbot_voting_power", vp, labels)
         self.reporter.vote_status(
                 self.account,
                 vp,
-                sum([entry[0] for entry in self.vote_queue if entry[0] > 0])/100,
+                self.vote_queue.positive/100,
                 len(self.vote_queue))
 
     def add_to_vote_queue(self, strength, author, permlink, ts):
-        queueweight = (sum([entry[0] for entry in self.vote_queue]) + strength)/100000
+        queueweight = (self.vote_queue.total + strength)/100000
         if queueweight > 1:
             vote_strength = int(strength/queueweight)
             print("Voting queue over full, downgrading vote from", strength, "to", vote_strength)
         else:
             vote_strength = strength
-        self.vote_queue.append([vote_strength, author, permlink, ts]) 
+        self.vote_queue.append(VoteEntry(vote_strength, author, permlink, ts)) 
             
 
 
+class InterestIndex:
+    def __init__(self, voters):
+        self.voters = voters
+        self.rebuild()
+
+    def rebuild(self):
+        authors = {}
+        tags = {}
+        blacklisted = {}
+        for position, voter in enumerate(self.voters):
+            for author in voter.following:
+                authors.setdefault(author, []).append(position)
+            for tag in voter.subscriptions:
+                tags.setdefault(tag, []).append(position)
+            for author in voter.blacklist:
+                blacklisted.setdefault(author, set()).add(position)
+        # Published as one tuple so a lookup never mixes old and new tables.
+        self.index = (authors, tags, blacklisted)
+
+    def match(self, author, tags):
+        authors, tag_index, blacklisted = self.index
+        positions = None
+        if author in authors:
+            positions = set(authors[author])
+        for tag in tags:
+            if tag in tag_index:
+                if positions is None:
+                    positions = set()
+                positions.update(tag_index[tag])
+        if positions is None:
+            return []
+        if author in blacklisted:
+            positions -= blacklisted[author]
+        return [self.voters[position] for position in sorted(positions)]
+
+class VoteBroadcaster:
+    def __init__(self, pool, max_ops=10):
+        self.pool = pool
+        self.max_ops = max_ops
+
+    def run(self, voters):
+        now = time.time()
+        batches = []
+        for voter in voters:
+            voter.expire(now)
+            try:
+                vote = voter.next_vote(now)
+            except RPCNodeException as exp:
+                print(voter.account, "SKIPPING VOTE:", exp)
+                continue
+            if vote is None:
+                continue
+            # One vote per account per transaction, so signatures and votes never clash.
+            for batch in batches:
+                if len(batch) < self.max_ops and vote.voter.account not in {item.voter.account for item in batch}:
+                    batch.append(vote)
+                    break
+            else:
+                batches.append([vote])
+        for batch in batches:
+            self.broadcast(batch)
+        for voter in voters:
+            try:
+                voter.report_status()
+            except RPCNodeException:
+                pass
+
+    def broadcast(self, batch):
+        wifs = []
+        for vote in batch:
+            if vote.voter.wif not in wifs:
+                wifs.append(vote.voter.wif)
+        try:
+            self.pool.broadcast([vote.operation() for vote in batch], wifs)
+        except RPCNodeException as exp:
+            if len(batch) == 1:
+                batch[0].voter.vote_failed(batch[0], exp)
+            else:
+                # The transaction is all or nothing, retry one by one to find out who failed.
+                print("BATCH VOTE ERROR:", exp)
+                for vote in batch:
+                    self.broadcast([vote])
+            return
+        for vote in batch:
+            vote.voter.vote_cast(vote)
+
+class PostCache:
+    def __init__(self, max_entries=50000, ttl=7*24*3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.posts = OrderedDict()
+        self.newest = 0
+
+    def add(self, author, permlink, ts, tags, edit=False):
+        key = (author, permlink)
+        old = self.posts.get(key)
+        if old is not None:
+            # Edits keep the original creation time and payout options.
+            self.posts[key] = (old[0], tuple(tags), old[2])
+            return
+        if edit:
+            return
+        # A full-body edit of a post we never saw looks just like a new post,
+        # so nothing is trusted until comment_options_operation confirms it.
+        self.posts[key] = (ts, tuple(tags), None)
+        self.newest = max(self.newest, ts)
+        self.evict()
+
+    def options(self, author, permlink, percent_hbd):
+        key = (author, permlink)
+        old = self.posts.get(key)
+        if old is not None:
+            self.posts[key] = (old[0], old[1], percent_hbd)
+
+    def confirm(self, author, permlink, ts, tags, percent_hbd):
+        self.posts[(author, permlink)] = (ts, tuple(tags), percent_hbd)
+        self.posts.move_to_end((author, permlink))
+        self.evict()
+
+    def get(self, author, permlink):
+        key = (author, permlink)
+        entry = self.posts.get(key)
+        if entry is None or entry[0] < self.newest - self.ttl:
+            METRICS.inc("silentbot_post_cache_total", {"result": "miss"})
+            return None
+        if entry[2] is None:
+            METRICS.inc("silentbot_post_cache_total", {"result": "unconfirmed"})
+            return None
+        self.posts.move_to_end(key)
+        METRICS.inc("silentbot_post_cache_total", {"result": "hit"})
+        return entry
+
+    def evict(self):
+        limit = self.newest - self.ttl
+        while self.posts:
+            key, entry = next(iter(self.posts.items()))
+            if len(self.posts) <= self.max_entries and entry[0] >= limit:
+                break
+            del self.posts[key]
+        METRICS.set("silentbot_post_cache_entries", len(self.posts))
+
 class Responder:
-    def __init__(self, account, wif, blacklist, lookup, tribe, tags, reporter):
+    def __init__(self, account, wif, blacklist, lookup, tribe, tags, reporter, pool, journal, scheduler, posts):
         self.account = account
         self.wif = wif
+        self.pool = pool
+        self.journal = journal
+        self.scheduler = scheduler
+        self.posts = posts
         self.blacklist = blacklist
         self.lookup = lookup
         self.tribe = tribe
@@ -402,6 +1450,9 @@ class Responder:
         self.non_curator = set()
         self.tag_abusers = {}
         self.spammer = set()
+        self.authored = set()
+        self.authored_bootstrapped = False
+        self.pending = {}
         self.reporter = reporter
 
     def backup(self):
@@ -409,6 +1460,9 @@ class Responder:
         rval["noncur"] = list(self.non_curator)
         rval["tag_abuse"] = self.tag_abusers
         rval["spam"] = list(self.spammer)
+        if self.authored_bootstrapped:
+            rval["authored"] = list(self.authored)
+        rval["pending"] = self.pending
         return rval
 
     def restore(self, obj):
@@ -418,35 +1472,82 @@ class Responder:
             self.tag_abusers = obj["tag_abuse"]
         if "spam" in obj:
             self.spammer = set(obj["spam"])
+        if "authored" in obj:
+            self.authored.update(obj["authored"])
+            self.authored_bootstrapped = True
+        if "pending" in obj:
+            self.pending = obj["pending"]
+
+    def bootstrap_authored(self):
+        start = -1
+        while True:
+            if start == -1:
+                limit = 1000
+            else:
+                limit = min(1000, start + 1)
+            # Operation filter bit 1 selects comment operations only.
+            history = retry(lambda: self.pool.call("get_account_history", self.account, start, limit, 2),
+                            "Responder.bootstrap_authored")
+            for index, entry in history:
+                op = entry["op"]
+                if op[0] == "comment" and op[1]["author"] == self.account:
+                    self.authored.add(op[1]["permlink"])
+            if len(history) < limit or history[0][0] == 0:
+                break
+            start = history[0][0] - 1
+        self.authored_bootstrapped = True
+        print("Found", len(self.authored), "comments previously posted by", self.account)
+
+    def authored_operation(self, permlink):
+        if permlink not in self.authored:
+            self.authored.add(permlink)
+            self.journal.log("authored", permlink)
+
+    def replay(self, record):
+        if record[0] == "authored":
+            self.authored.add(record[1])
+        elif record[0] == "noncur":
+            self.non_curator.add(record[1])
+        elif record[0] == "spam":
+            self.spammer.add(record[1])
+        elif record[0] == "tag_abuse":
+            self.tag_abusers[record[1]] = record[2]
+        elif record[0] == "pending":
+            self.pending[record[1]] = record[2]
+        elif record[0] == "resolved":
+            self.pending.pop(record[1], None)
+
+    def post_meta(self, post):
+        entry = self.posts.get(post[0], post[1])
+        if entry is not None:
+            return entry
+        original_post = self.pool.call("get_post", {"author": post[0], "permlink": post[1]}, api="bridge")
+        if "created" in original_post:
+            ts = parse_timestamp(original_post["created"])
+        else:
+            ts = 0
+        tags = ()
+        if "json_metadata" in original_post and isinstance(original_post["json_metadata"], dict) and "tags" in original_post["json_metadata"] and isinstance(original_post["json_metadata"]["tags"], list):
+            tags = tuple(original_post["json_metadata"]["tags"])
+        if "percent_hbd" in original_post:
+            self.posts.confirm(post[0], post[1], ts, tags, original_post["percent_hbd"])
+        return ts, tags, original_post.get("percent_hbd")
 
     def star(self, comment, post, star_count, voters, curator):
         if post[0] in self.blacklist:
             self.is_blacklisted(comment, post)
             return
-        original_post = None
-        while original_post is None:
-            try:
-                original_post = Client()("bridge").get_post({"author": post[0], "permlink": post[1]})
-            except RPCNodeException as exp:
-                print(exp)
-                time.sleep(5)
-        if "json_metadata" in original_post and isinstance(original_post["json_metadata"], dict) and "tags" in original_post["json_metadata"] and isinstance(original_post["json_metadata"]["tags"], list) and self.tribe in original_post["json_metadata"]["tags"]:
-            if "created" in original_post:
-                ts = dateutil.parser.parse(original_post["created"]).timestamp()
-            else:
-                ts = 0
+        ts, post_tags, percent_hbd = self.post_meta(post)
+        if self.tribe in post_tags:
             has_tag = False
             for tag in self.tags:
-                if tag in original_post["json_metadata"]["tags"]:
+                if tag in post_tags:
                     has_tag = True
             if has_tag:
                 our_comment_permlink  = "-".join(post[0].split(".")) + "-" + post[1] + "-" + self.account
-                try:
-                    our_comment = Client().get_content(self.account, our_comment_permlink)
+                if our_comment_permlink in self.authored:
                     return
-                except:
-                    pass
-                power_up = "percent_hbd" in original_post and original_post["percent_hbd"] == 0
+                power_up = percent_hbd == 0
                 if star_count > 5:
                     star_count = 5
                 if star_count < 1:
@@ -465,13 +1566,8 @@ class Responder:
                         "app": "SilentBot 0.1.3"
                         })
                 })
-                resp = None
-                while resp is None:
-                    try:
-                        resp = Client(keys=[self.wif]).broadcast(my_post)
-                    except RPCNodeException as exp:
-                        print(exp)
-                        time.sleep(5)
+                self.pool.broadcast(my_post, self.wif)
+                self.authored_operation(our_comment_permlink)
                 self.reporter.rate(curator, post[0], post[1], star_count)
                 for voter in voters:
                     voter.add_to_vote_queue(config["percentage"], post[0], post[1], ts)
@@ -485,23 +1581,10 @@ class Responder:
             percentage = -10000
         else:
             percentage = -5000
-        original_post = None
-        while original_post is None:
-            try:
-                original_post = Client()("bridge").get_post({"author": post[0], "permlink": post[1]})
-            except RPCNodeException as exp:
-                print(exp)
-                time.sleep(5)
-        if "created" in original_post:
-            ts = dateutil.parser.parse(original_post["created"]).timestamp()
-        else:
-            ts = 0
+        ts = self.post_meta(post)[0]
         our_comment_permlink  = "-".join(post[0].split(".")) + "-" + post[1] + "-" + self.account
-        try:
-            our_comment = Client().get_content(self.account, our_comment_permlink)
+        if our_comment_permlink in self.authored:
             return
-        except:
-            pass
         config = self.lookup[0][0]
         body = '<A HREF="' + config["link"] + '"><IMG SRC="' + config["icon"] + '"></A>'
         my_post = Operation('comment', {
@@ -516,16 +1599,13 @@ class Responder:
                         "app": "SilentBot 0.1.3"
                         })
         })
-        resp = None
-        while resp is None:
-            try:
-                resp = Client(keys=[self.wif]).broadcast(my_post)
-            except RPCNodeException as exp:
-                print(exp)
-                time.sleep(5)
+        self.pool.broadcast(my_post, self.wif)
+        self.authored_operation(our_comment_permlink)
         for voter in voters:
             voter.add_to_vote_queue(percentage, post[0], post[1], ts)
-        self.spammer.add(post[0])
+        if post[0] not in self.spammer:
+            self.spammer.add(post[0])
+            self.journal.log("spam", post[0])
 
     def tag_abuse(self, post, voters):
         if post[0] in self.tag_abusers:
@@ -538,23 +1618,10 @@ class Responder:
             percentage = -1000
         else:
             percentage = -100
-        original_post = None
-        while original_post is None:
-            try:
-                original_post = Client()("bridge").get_post({"author": post[0], "permlink": post[1]})
-            except RPCNodeException as exp:
-                print(exp)
-                time.sleep(5)
-        if "created" in original_post:
-                ts = dateutil.parser.parse(original_post["created"]).timestamp()
-        else:
-            ts = 0
+        ts = self.post_meta(post)[0]
         our_comment_permlink  = "-".join(post[0].split(".")) + "-" + post[1] + "-" + self.account
-        try:
-            our_comment = Client().get_content(self.account, our_comment_permlink)
+        if our_comment_permlink in self.authored:
             return
-        except:
-            pass
         config = self.lookup[1][0]
         body = '<A HREF="' + config["link"] + '"><IMG SRC="' + config["icon"] + '"></A>'
         my_post = Operation('comment', {
@@ -569,23 +1636,16 @@ class Responder:
                         "app": "SilentBot 0.1.3"
                         })
         })
-        resp = None
-        while resp is None:
-            try:
-                resp = Client(keys=[self.wif]).broadcast(my_post)
-            except RPCNodeException as exp:
-                print(exp)
-                time.sleep(5)
+        self.pool.broadcast(my_post, self.wif)
+        self.authored_operation(our_comment_permlink)
         for voter in voters:
             voter.add_to_vote_queue(percentage, post[0], post[1], ts)
         self.tag_abusers[post[0]] = ta_count
+        self.journal.log("tag_abuse", post[0], ta_count)
     def respond(self, comment, body):
         our_comment_permlink  = "-".join(comment[0].split(".")) + "-" + comment[1] + "-" + self.account
-        try:
-            our_comment = Client().get_content(self.account, our_comment_permlink)
+        if our_comment_permlink in self.authored:
             return
-        except:
-            pass
         post = Operation('comment', {
                         "parent_author": comment[0],
                         "parent_permlink": comment[1],
@@ -598,17 +1658,14 @@ class Responder:
                           "app": "SilentBot 0.1.3"
                         })
                     })
-        resp = None
-        while resp is None:
-            try:
-                resp = Client(keys=[self.wif]).broadcast(post)
-            except RPCNodeException as exp:
-                print(exp)
+        self.pool.broadcast(post, self.wif)
+        self.authored_operation(our_comment_permlink)
 
     def not_a_currator(self, comment):
         if comment[0] not in self.non_curator:
+            self.respond(comment,"I'm terribly sorry, but I don't recognize you as a Silent Bob curator")
             self.non_curator.add(comment[0])
-            return self.respond(comment,"I'm terribly sorry, but I don't recognize you as a Silent Bob curator")
+            self.journal.log("noncur", comment[0])
 
     def is_blacklisted(self, comment, post):
         body = "I'm really sorry for the inconvenience, but one of the Silent Bob curators has blacklisted @" + post[0]
@@ -624,8 +1681,37 @@ class Responder:
             body += " #" + tag
         self.respond(comment, body)
 
-    def mention(self, post, comment, body, voters, curators):
+    def mention(self, post, comment, body, voters, curators, block=None):
         print("####################", self.account, "######################")
+        key = "command:" + comment[0] + "/" + comment[1]
+        try:
+            self.execute(key, post, comment, body, voters, curators)
+        except RPCNodeException as exp:
+            # Journaled, so a restart before it succeeds picks it up again.
+            print("DEFERRED:", key, exp)
+            self.pending[key] = [post, comment, body, block]
+            self.journal.log("pending", key, self.pending[key])
+            self.defer(key, voters, curators)
+
+    def defer(self, key, voters, curators):
+        post, comment, body, block = self.pending[key]
+        self.scheduler.defer(key, lambda: self.execute(key, post, comment, body, voters, curators), persistent=True)
+
+    def requeue(self, voters, curators):
+        for key in self.pending:
+            print("Requeueing pending command", key, "from block", self.pending[key][3])
+            self.defer(key, voters, curators)
+
+    def execute(self, key, post, comment, body, voters, curators):
+        self.command(post, comment, body, voters, curators)
+        if key in self.pending:
+            del self.pending[key]
+            self.journal.log("resolved", key)
+        # What the command did must survive a crash before the next sync, or
+        # a replayed command would comment, rate and queue votes a second time.
+        self.journal.flush()
+
+    def command(self, post, comment, body, voters, curators):
         parts = body.split("@" + self.account)
         if len(parts) == 2:
             cmd = parts[1].split(" ")[1:3]
@@ -656,20 +1742,277 @@ class Responder:
                             return self.not_a_currator(comment)
         return
 
+class BlockArchive:
+    SEGMENT = 1000
+    ENTRY = struct.Struct("<II")
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        self.size = sum(entry.stat().st_size for entry in os.scandir(path) if entry.name.endswith(".blk"))
+
+    def segment_path(self, blockno):
+        return os.path.join(self.path, "seg-%010d.blk" % (blockno - blockno % self.SEGMENT))
+
+    def get_range(self, start, count, raw=False):
+        blocks = []
+        with self.lock:
+            while len(blocks) < count:
+                blockno = start + len(blocks)
+                path = self.segment_path(blockno)
+                try:
+                    with open(path, "rb") as infil:
+                        with mmap.mmap(infil.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                            slot = blockno % self.SEGMENT
+                            while slot < self.SEGMENT and len(blocks) < count:
+                                offset, length = self.ENTRY.unpack_from(mapped, slot * self.ENTRY.size)
+                                if length == 0:
+                                    return None
+                                if raw:
+                                    # Left compressed for a parse worker to unpack.
+                                    blocks.append(mapped[offset:offset + length])
+                                else:
+                                    blocks.append(json.loads(zlib.decompress(mapped[offset:offset + length])))
+                                slot += 1
+                except FileNotFoundError:
+                    return None
+                except (ValueError, zlib.error, struct.error) as exp:
+                    # Torn or corrupt segment, drop it and let the network fill it again.
+                    print("ARCHIVE: dropping bad segment", path, exp)
+                    METRICS.inc("silentbot_archive_corrupt_total")
+                    self.drop(path)
+                    return None
+        return blocks
+
+    def discard(self, start, count):
+        with self.lock:
+            for blockno in range(start - start % self.SEGMENT, start + count, self.SEGMENT):
+                self.drop(self.segment_path(blockno))
+
+    def drop(self, path):
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+            self.size -= size
+        except FileNotFoundError:
+            pass
+
+    def put(self, start, blocks, raw=False):
+        with self.lock:
+            index = 0
+            while index < len(blocks):
+                blockno = start + index
+                path = self.segment_path(blockno)
+                if not os.path.exists(path):
+                    with open(path, "wb") as outfil:
+                        outfil.write(bytes(self.SEGMENT * self.ENTRY.size))
+                    self.size += self.SEGMENT * self.ENTRY.size
+                with open(path, "r+b") as outfil:
+                    slot = blockno % self.SEGMENT
+                    entries = []
+                    while slot < self.SEGMENT and index < len(blocks):
+                        outfil.seek(slot * self.ENTRY.size)
+                        if self.ENTRY.unpack(outfil.read(self.ENTRY.size))[1] == 0:
+                            if raw:
+                                data = blocks[index]
+                            else:
+                                data = zlib.compress(json.dumps(blocks[index]).encode())
+                            offset = outfil.seek(0, os.SEEK_END)
+                            outfil.write(data)
+                            entries.append((slot, offset, len(data)))
+                            self.size += len(data)
+                        slot += 1
+                        index += 1
+                    # Data first, index second: an index entry never points at unwritten data.
+                    outfil.flush()
+                    os.fsync(outfil.fileno())
+                    for slot, offset, length in entries:
+                        outfil.seek(slot * self.ENTRY.size)
+                        outfil.write(self.ENTRY.pack(offset, length))
+                    outfil.flush()
+                    os.fsync(outfil.fileno())
+            if self.size > self.max_bytes:
+                self.evict()
+
+    def evict(self):
+        segments = sorted((entry.stat().st_mtime, entry.path, entry.stat().st_size)
+                          for entry in os.scandir(self.path) if entry.name.endswith(".blk"))
+        for mtime, path, size in segments:
+            if self.size <= self.max_bytes * 0.9:
+                break
+            os.remove(path)
+            self.size -= size
+
+class BlockFetcher:
+    def __init__(self, pool, start, end, depth=2, window=100, nodes=None, archive=None, irreversible=0, extract=None, workers=0):
+        self.pool = pool
+        self.archive = archive
+        self.extract = extract
+        self.irreversible = irreversible
+        self.next_start = start
+        self.end = end
+        self.depth = depth
+        self.window = window
+        if nodes:
+            self.nodes = nodes
+        else:
+            self.nodes = [None]
+        self.node_index = 0
+        self.pending = deque()
+        # A fetch thread waits for its parse worker, so give every worker a thread.
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(len(self.nodes), workers))
+        self.fill()
+
+    def fetch(self, start, count, node_index):
+        if self.archive is not None:
+            blocks = self.archive.get_range(start, count, self.extract is not None)
+            if blocks is not None and self.extract is not None:
+                try:
+                    blocks, archived, parse_time = self.extract(start, blocks, 0)
+                    # Worker side decoding and predicate time.
+                    METRICS.observe("silentbot_stage_seconds", parse_time, {"stage": "parse"})
+                except (zlib.error, ValueError, KeyError) as exp:
+                    print("ARCHIVE: dropping bad range", start, exp)
+                    METRICS.inc("silentbot_archive_corrupt_total")
+                    self.archive.discard(start, count)
+                    blocks = None
+            if blocks is not None:
+                return blocks
+        archive_upto = 0
+        if self.archive is not None:
+            archive_upto = self.irreversible
+        start_time = time.time()
+        parse_time = 0
+        attempt = 0
+        blocks = None
+        while blocks is None:
+            node = self.nodes[node_index % len(self.nodes)]
+            if node is not None and not self.pool.available(node):
+                node = None
+            try:
+                if self.extract is None:
+                    blocks = self.pool.call("get_block_range", {"starting_block_num": start, "count":count}, api="block_api", node=node)["blocks"]
+                else:
+                    payload = self.pool.call_raw("get_block_range", {"starting_block_num": start, "count":count}, api="block_api", node=node)
+                    blocks, archived, parse_time = self.extract(start, payload, archive_upto)
+            except (RPCNodeException, ValueError, KeyError) as exp:
+                print(node, exp)
+                METRICS.inc("silentbot_retries_total", {"site": "BlockFetcher.fetch"})
+                # Let the next node have a go at this range.
+                node_index += 1
+                time.sleep(backoff(attempt, 1.0, 30.0))
+                attempt += 1
+                continue
+            if len(blocks) == 0:
+                blocks = None
+                time.sleep(3)
+        METRICS.observe("silentbot_stage_seconds", time.time() - start_time - parse_time, {"stage": "fetch"})
+        if self.extract is not None:
+            METRICS.observe("silentbot_stage_seconds", parse_time, {"stage": "parse"})
+            if archived:
+                self.archive.put(start, archived, True)
+        elif self.archive is not None and start <= self.irreversible:
+            # Only archive irreversible blocks, a forked out block must never be replayed.
+            self.archive.put(start, blocks[:self.irreversible + 1 - start])
+        return blocks
+
+    def fill(self):
+        while len(self.pending) < self.depth and self.next_start <= self.end:
+            count = min(self.window, self.end + 1 - self.next_start)
+            future = self.executor.submit(self.fetch, self.next_start, count, self.node_index)
+            self.pending.append([self.next_start, count, future])
+            self.next_start += count
+            self.node_index += 1
+
+    def extend(self, end, irreversible=0):
+        self.irreversible = max(self.irreversible, irreversible)
+        if end > self.end:
+            self.end = end
+            self.fill()
+
+    def reset(self, start):
+        for entry in self.pending:
+            entry[2].cancel()
+        self.pending.clear()
+        self.next_start = start
+        self.fill()
+
+    def next_batch(self):
+        if len(self.pending) == 0:
+            return None
+        start, count, future = self.pending.popleft()
+        self.fill()
+        wait_start = time.time()
+        blocks = future.result()
+        METRICS.observe("silentbot_stage_seconds", time.time() - wait_start, {"stage": "fetch_wait"})
+        if len(blocks) < count:
+            # Node returned a short range (usually right at head), refetch the
+            # gap so blocks are never handed out of order.
+            self.reset(start + len(blocks))
+        return start, blocks
+
+    def close(self):
+        for entry in self.pending:
+            entry[2].cancel()
+        self.pending.clear()
+        self.executor.shutdown(wait=False)
+
+
 class SilentBot:
-    def __init__(self, bot_account, wif_map, curators, voters):
+    def __init__(self, bot_account, wif_map, curators, voters, lupath=None, pool=None, datadir=None, stake_session=None):
         self.bot_account = bot_account
+        self.mention_prefix = "@" + bot_account + " "
         self.curator_names = set(curators)
-        lupath = os.path.join(os.path.dirname(os.path.realpath(__file__)),"sb-lookup.json")
+        if lupath is None:
+            lupath = os.path.join(os.path.dirname(os.path.realpath(__file__)),"sb-lookup.json")
         with open(lupath) as lufil:
             lup = json.load(lufil)
         lookup = lup["responses"]
         tribe = lup["tribe"]
         tags = lup["tags"]
-        self.ts = TokenStake(["CCC","WIT"], voters + [bot_account])
-        self.reporter = Reporter(bot_account, wif_map[bot_account], tribe, self.ts)
-        self.voters = [Voter(item, wif_map[item], self.reporter) for item in voters]
-        self.voters.append(Voter(bot_account, wif_map[bot_account], self.reporter))
+        self.prefetch = lup.get("prefetch", 2)
+        if pool is None:
+            pool = ClientPool(lup.get("nodes", DEFAULT_NODES))
+        self.pool = pool
+        self.catchup_threshold = lup.get("catchup_threshold", 1000)
+        self.parse_workers = lup.get("parse_workers", min(4, (os.cpu_count() or 1) - 1))
+        self.broadcaster = VoteBroadcaster(self.pool, lup.get("vote_batch", 10))
+        self.follow = lup.get("follow_head", True)
+        self.follow_window = 20
+        self.vote_interval = lup.get("vote_interval", 3)
+        self.checkpoint_interval = lup.get("checkpoint_interval", 15)
+        if datadir is not None:
+            self.bupath = os.path.join(datadir, "sb-backup.json")
+        elif "SILENTBOT_DATA_DIR" in os.environ:
+            self.bupath = os.path.join(os.environ["SILENTBOT_DATA_DIR"], "sb-backup.json")
+        else:
+            self.bupath = os.path.join(os.path.dirname(os.path.realpath(__file__)),"sb-backup.json")
+        self.journal = StateJournal(self.bupath)
+        self.scheduler = Scheduler()
+        self.posts = PostCache(lup.get("post_cache_size", 50000))
+        self.tribe_quoted = '"' + tribe + '"'
+        self.router = OperationRouter({
+            "account": bot_account,
+            "mention_prefix": self.mention_prefix,
+            "tribe_quoted": self.tribe_quoted
+        })
+        if "SILENTBOT_ARCHIVE_DIR" in os.environ:
+            self.archive = BlockArchive(os.environ["SILENTBOT_ARCHIVE_DIR"],
+                                        int(os.environ.get("SILENTBOT_ARCHIVE_MB", "2048")) * 1024 * 1024)
+        else:
+            self.archive = None
+        self.irreversible = 0
+        self.ts = TokenStake(["CCC","WIT"], voters + [bot_account], self.pool, stake_session)
+        self.reporter = Reporter(bot_account, wif_map[bot_account], tribe, self.ts, self.pool, self.journal, self.scheduler)
+        self.social = SocialGraph(voters + [bot_account], self.pool,
+                                  os.path.join(os.path.dirname(self.bupath), "sb-social.json"),
+                                  lup.get("social_refresh", 3600))
+        self.planner = VotePlanner(lup.get("vp_floor", 0.0), lup.get("vote_spacing", 3))
+        self.voters = [Voter(item, wif_map[item], self.reporter, self.pool, self.journal, index, self.social, self.planner) for index, item in enumerate(voters)]
+        self.voters.append(Voter(bot_account, wif_map[bot_account], self.reporter, self.pool, self.journal, len(voters), self.social, self.planner))
+        self.interest = InterestIndex(self.voters)
         self.responder = Responder(
                 bot_account,
                 wif_map[bot_account],
@@ -677,23 +2020,38 @@ class SilentBot:
                 lookup,
                 tribe,
                 tags,
-                self.reporter)
-        if "SILENTBOT_DATA_DIR" in os.environ:
-            self.bupath = os.path.join(os.environ["SILENTBOT_DATA_DIR"], "sb-backup.json")
-        else:
-            self.bupath = os.path.join(os.path.dirname(os.path.realpath(__file__)),"sb-backup.json")
-        self.headno = None
-        while self.headno is None:
-            try:
-                self.headno = Client().get_dynamic_global_properties()["head_block_number"]
-            except RPCNodeException as exp:
-                print(exp)
-                time.sleep(5)
+                self.reporter,
+                self.pool,
+                self.journal,
+                self.scheduler,
+                self.posts)
+        self.headno = self.get_head()
         self.headno_age = time.time()
         self.next = self.headno - 100
+        self.register_handlers()
+        self.social.listeners.append(self.social_refreshed)
+        self.social.start()
         self.restore()
+        if not self.responder.authored_bootstrapped:
+            self.responder.bootstrap_authored()
+            self.snapshot()
+
+    def social_refreshed(self):
+        # Called from the refresh thread; swapping whole sets keeps readers consistent.
+        for voter in self.voters:
+            voter.blacklist, voter.following, voter.subscriptions = self.social.lists(voter.account)
+        self.responder.blacklist = set(itertools.chain().from_iterable([voter.blacklist for voter in self.voters]))
+        self.interest.rebuild()
 
     def sync(self):
+        start = time.time()
+        self.journal.commit(self.next)
+        METRICS.observe("silentbot_stage_seconds", time.time() - start, {"stage": "checkpoint"})
+        if self.journal.needs_compaction():
+            self.snapshot()
+
+    def snapshot(self):
+        start = time.time()
         obj = dict()
         obj["block"] = self.next
         obj["voters"] = dict()
@@ -701,17 +2059,14 @@ class SilentBot:
             obj["voters"][voter.account] = voter.backup()
         obj["responder"] = self.responder.backup()
         obj["reporter"] = self.reporter.backup()
-        with open(self.bupath, "w") as outfil:
-            json.dump(obj, outfil)
+        self.journal.snapshot(obj)
+        METRICS.observe("silentbot_stage_seconds", time.time() - start, {"stage": "snapshot"})
 
     def restore(self):
-        try:
-            with open(self.bupath) as infil:
-               obj = json.load(infil)
-        except FileNotFoundError:
-            self.sync()
-            with open(self.bupath) as infil:
-               obj = json.load(infil)
+        obj, entries = self.journal.load()
+        if obj is None:
+            self.snapshot()
+            return
         self.next = obj["block"]
         if "voters" in obj:
             for voter in self.voters:
@@ -721,107 +2076,254 @@ class SilentBot:
             self.responder.restore(obj["responder"])
         if "reporter" in obj:
             self.reporter.restore(obj["reporter"])
+        for entry in entries:
+            for record in entry["ops"]:
+                if record[0] in ("push", "pop", "remove"):
+                    index, kind, account = record[1]
+                    if index < len(self.voters) and self.voters[index].account == account:
+                        self.voters[index].replay(record)
+                elif record[0] in ("authored", "noncur", "spam", "tag_abuse", "pending", "resolved"):
+                    self.responder.replay(record)
+                else:
+                    self.reporter.replay(record)
+            self.next = entry["block"]
+        print("Restored state at block", self.next, "replaying", len(entries), "journal entries")
+        self.responder.requeue(self.voters, self.curator_names)
+        # Fold the replayed journal into a fresh snapshot.
+        self.snapshot()
+
+    def get_head(self, deadline=None):
+        props = retry(lambda: self.pool.call("get_dynamic_global_properties"), "SilentBot.get_head", deadline)
+        self.irreversible = props.get("last_irreversible_block_num", 0)
+        return props["head_block_number"]
+
+    def register_handlers(self):
+        self.router.register("comment_operation", self.on_own_comment, own_operation, ("permlink",))
+        self.router.register("comment_operation", self.on_mention, mentions_account,
+                             ("parent_author", "parent_permlink", "author", "permlink", "body"))
+        self.router.register("comment_operation", self.on_tribe_post, top_level_post, ("author", "permlink"))
+        self.router.register("comment_operation", self.on_candidate_post, top_level_post, ("author", "permlink"))
+        self.router.register("comment_options_operation", self.on_comment_options, None,
+                             ("author", "permlink", "percent_hbd"))
+
+    def on_own_comment(self, vals, ts, match):
+        self.responder.authored_operation(vals["permlink"])
+
+    def on_mention(self, vals, ts, match):
+        self.responder.mention([vals["parent_author"], vals["parent_permlink"]],
+                               [vals["author"], vals["permlink"]],
+                               vals["body"],
+                               self.voters,
+                               self.curator_names,
+                               self.next)
+
+    def on_tribe_post(self, vals, ts, post):
+        # Remember tribe posts so star commands need not look them up again.
+        if post["tribe"]:
+            self.posts.add(vals["author"], vals["permlink"], ts, post["tags"], post["edit"])
+
+    def on_candidate_post(self, vals, ts, post):
+        if post["candidate"]:
+            for voter in self.interest.match(vals["author"], post["tags"]):
+                voter.add_just_in_case(vals["author"], vals["permlink"], ts)
+
+    def on_comment_options(self, vals, ts, match):
+        self.posts.options(vals["author"], vals["permlink"], vals["percent_hbd"])
+
+    def vote_tick(self):
+        start = time.time()
+        self.scheduler.run_due()
+        self.broadcaster.run(self.voters)
+        METRICS.observe("silentbot_stage_seconds", time.time() - start, {"stage": "vote"})
+
+    def apply_events(self, ts, events):
+        if events is None:
+            return 0
+        start = time.time()
+        self.router.apply(events, ts)
+        self.next +=1
+        METRICS.observe("silentbot_stage_seconds", time.time() - start, {"stage": "dispatch"})
+        METRICS.inc("silentbot_blocks_total")
+        return 1
+
+    def process_block(self, block, ts=None):
+        start = time.time()
+        if ts is None:
+            ts = parse_timestamp(block["timestamp"])
+        if "transactions" in block:
+            # Predicates decode whatever metadata they need, that counts as parsing.
+            table, context = self.router.spec()
+            events = match_operations(block, table, context)
+            parse_time = time.time() - start
+            self.router.apply(events, ts)
+            self.next +=1
+            METRICS.observe("silentbot_stage_seconds", parse_time, {"stage": "parse"})
+            METRICS.observe("silentbot_stage_seconds", time.time() - start - parse_time, {"stage": "dispatch"})
+            METRICS.inc("silentbot_blocks_total")
+            return 1
+        return 0
+
+    def run(self):
+        MultiBot([self]).run()
+
+
+class MultiBot:
+    def __init__(self, tenants):
+        self.tenants = tenants
+        self.lead = tenants[0]
+        self.pool = self.lead.pool
+
+    def cursor(self):
+        return min(tenant.next for tenant in self.tenants)
+
+    def get_head(self, deadline=None):
+        headno = self.lead.get_head(deadline)
+        for tenant in self.tenants:
+            tenant.headno = headno
+            tenant.irreversible = self.lead.irreversible
+        return headno
+
+    def set_lag(self, headno):
+        METRICS.set("silentbot_head_block", headno)
+        METRICS.set("silentbot_head_lag_blocks", headno + 1 - self.cursor())
+
+    def fan_out(self, start, blocks):
+        rval = 0
+        for offset, block in enumerate(blocks):
+            blockno = start + offset
+            ts = parse_timestamp(block["timestamp"])
+            # Each tenant keeps its own cursor, one that is ahead simply skips the block.
+            for tenant in self.tenants:
+                if tenant.next == blockno:
+                    rval += tenant.process_block(block, ts)
+        return rval
+
+    def fan_out_events(self, start, results):
+        rval = 0
+        for offset, (ts, per_spec) in enumerate(results):
+            blockno = start + offset
+            for index, tenant in enumerate(self.tenants):
+                if tenant.next == blockno:
+                    rval += tenant.apply_events(ts, per_spec[index] if per_spec is not None else None)
+        return rval
 
     def upto_head(self):
         processed = 0
-        self.headno = None
-        while self.headno is None:
-            try:
-                self.headno = Client().get_dynamic_global_properties()["head_block_number"]
-            except RPCNodeException as exp:
-                print(exp)
-                time.sleep(5)
+        headno = self.get_head()
         start_time = time.time()
         rval = 0
-        blocks_left = self.headno + 1 - self.next
-        while blocks_left !=0:
-            if blocks_left > 100:
-                count = 100
-                blocks_left -= 100
-            else:
-                count = blocks_left
-                blocks_left = 0
-            blocks = None
-            while blocks is None:
-                try:
-                    blocks = Client()('block_api').get_block_range({"starting_block_num": self.next, "count":count})["blocks"]
-                except RPCNodeException as exp:
-                    print(exp)
-                    time.sleep(5)
-            for block in blocks:
-                ts = dateutil.parser.parse(block["timestamp"]).timestamp()
-                if "transactions" in block:
-                    for trans in block["transactions"]:
-                        if "operations" in  trans:
-                            for operation in  trans["operations"]:
-                                op_type = operation["type"]
-                                vals = operation["value"]
-                                if op_type == "comment_operation":
-                                    if vals["parent_author"]:
-                                        mentioned = False
-                                        if vals["json_metadata"]:
-                                            cust = json.loads(vals["json_metadata"])
-                                            if "users" in cust and self.bot_account in cust["users"]:
-                                                mentioned = True
-                                                self.responder.mention([vals["parent_author"], vals["parent_permlink"]],
-                                                                       [vals["author"], vals["permlink"]],
-                                                                       vals["body"],
-                                                                       self.voters,
-                                                                       self.curator_names)
-                                        if not mentioned and vals["body"].startswith("@" + self.bot_account + " "):
-                                            self.responder.mention([vals["parent_author"], vals["parent_permlink"]],
-                                                                       [vals["author"], vals["permlink"]],
-                                                                       vals["body"],
-                                                                       self.voters,
-                                                                       self.curator_names)
-                                    else:
-                                        if vals["json_metadata"]:
-                                            ok = False
-                                            try:
-                                                cust = json.loads(vals["json_metadata"])
-                                            except json.decoder.JSONDecodeError:
-                                                cust = {}
-                                            if "app" in cust and "tags" in cust:
-                                                ok = True
-                                                for prefix in ["exhaust", "3speak", "VIMM", "aureal", "actifit"]:
-                                                    if cust["app"].startswith(prefix):
-                                                        ok = False
-                                            if ok:
-                                                for voter in self.voters:
-                                                    voter.candidate_just_in_case(vals["author"], vals["permlink"], cust["tags"], ts)
-                    self.next +=1
-                    rval += 1
-            processed += count
-            total_time = time.time() - start_time
-            speed = processed/total_time
-            if blocks_left > 0:
-                self.headno = None
-                while self.headno is None:
+        lead = self.lead
+        cursor = self.cursor()
+        executor = None
+        if headno + 1 - cursor > lead.catchup_threshold and (len(self.pool.nodes) > 1 or lead.parse_workers > 0):
+            nodes = self.pool.ranked()
+            extract = None
+            if lead.parse_workers > 0:
+                # Token stake, social graph, metrics and fetch threads are running by
+                # now, so don't fork this process and its held locks: let a fork
+                # server (or fresh interpreters) start the workers.
+                if "forkserver" in multiprocessing.get_all_start_methods():
+                    context = multiprocessing.get_context("forkserver")
+                else:
+                    context = multiprocessing.get_context("spawn")
+                executor = concurrent.futures.ProcessPoolExecutor(lead.parse_workers, mp_context=context)
+                specs = [tenant.router.spec() for tenant in self.tenants]
+                extract = lambda start, payload, upto: executor.submit(extract_events, start, payload, specs, upto).result()
+            print("CATCH-UP MODE:", len(nodes), "nodes,", lead.parse_workers, "parse workers,", len(self.tenants), "tenants")
+            fetcher = BlockFetcher(self.pool, cursor, headno, max(lead.prefetch, 2 * len(nodes), 2 * lead.parse_workers),
+                                   nodes=nodes if len(nodes) > 1 else None,
+                                   archive=lead.archive, irreversible=lead.irreversible, extract=extract,
+                                   workers=lead.parse_workers)
+        else:
+            fetcher = BlockFetcher(self.pool, cursor, headno, lead.prefetch,
+                                   archive=lead.archive, irreversible=lead.irreversible)
+        try:
+            while True:
+                batch = fetcher.next_batch()
+                if batch is None:
+                    break
+                start, blocks = batch
+                count = len(blocks)
+                if fetcher.extract is None:
+                    rval += self.fan_out(start, blocks)
+                else:
+                    rval += self.fan_out_events(start, blocks)
+                processed += count
+                total_time = time.time() - start_time
+                speed = max(processed/total_time, 1)
+                blocks_left = headno + 1 - self.cursor()
+                if blocks_left > 0:
                     try:
-                        self.headno = Client().get_dynamic_global_properties()["head_block_number"]
+                        # Don't hold up processing for long, the old head still has work in it.
+                        headno = self.get_head(30)
                     except RPCNodeException as exp:
-                        print(exp)
-                        time.sleep(5)
-                blocks_left = self.headno + 1 - self.next
-            time_left = blocks_left/speed
-            print("BLOCK:", self.next-1, self.headno ,count,"processed", blocks_left, "left to go", int(speed),"blocks per second", int(time_left/60), "minutes to catch up.")
-            for voter in self.voters:
-                voter.vote_if_needed()
-            self.sync()
+                        print("HEAD REFRESH FAILED:", exp)
+                    blocks_left = headno + 1 - self.cursor()
+                    fetcher.extend(headno, lead.irreversible)
+                self.set_lag(headno)
+                time_left = blocks_left/speed
+                print("BLOCK:", self.cursor()-1, headno ,count,"processed", blocks_left, "left to go", int(speed),"blocks per second", int(time_left/60), "minutes to catch up.")
+                # The next ranges are already being fetched while we vote and checkpoint.
+                for tenant in self.tenants:
+                    tenant.vote_tick()
+                    tenant.sync()
+        finally:
+            fetcher.close()
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)
         return rval
 
+    def follow_head(self):
+        lead = self.lead
+        last_vote = 0
+        last_checkpoint = time.time()
+        while True:
+            cursor = self.cursor()
+            try:
+                blocks = self.pool.call("get_block_range", {"starting_block_num": cursor, "count": lead.follow_window}, api="block_api")["blocks"]
+            except RPCNodeException as exp:
+                print(exp)
+                METRICS.inc("silentbot_retries_total", {"site": "MultiBot.follow_head"})
+                blocks = []
+                time.sleep(1)
+            self.fan_out(cursor, blocks)
+            now = time.time()
+            if now - last_vote >= lead.vote_interval:
+                for tenant in self.tenants:
+                    tenant.vote_tick()
+                last_vote = now
+            if now - last_checkpoint >= lead.checkpoint_interval:
+                print("HEAD:", self.cursor()-1)
+                try:
+                    self.get_head(30)
+                except RPCNodeException as exp:
+                    print("HEAD REFRESH FAILED:", exp)
+                self.set_lag(lead.headno)
+                for tenant in self.tenants:
+                    tenant.sync()
+                    tenant.reporter.tick()
+                last_checkpoint = now
+            if len(blocks) == lead.follow_window:
+                # Fell behind, let upto_head catch up in bulk.
+                for tenant in self.tenants:
+                    tenant.sync()
+                return
+            if len(blocks) == 0:
+                time.sleep(1)
+
     def run(self):
-        lastsync = 0
         while True:
             count = self.upto_head()
-            self.reporter.tick()
-            sleeptime = 120 - count
-            if sleeptime > 0:
-                time.sleep(sleeptime)
-            
+            for tenant in self.tenants:
+                tenant.reporter.tick()
+            if self.lead.follow:
+                self.follow_head()
+            else:
+                sleeptime = 120 - count
+                if sleeptime > 0:
+                    time.sleep(sleeptime)
 
-if __name__ == "__main__":
-    lupath = os.path.join(os.path.dirname(os.path.realpath(__file__)),"sb-lookup.json")
+def load_tenant(lupath):
     with open(lupath) as lufil:
         lup = json.load(lufil)
     bot_account = lup["bot"]
@@ -837,5 +2339,32 @@ if __name__ == "__main__":
             print("ERROR:", voter.upper() + "_WIF environment variable not set!")
             sys.exit(1)
         wif_map[voter] = os.environ[voter.upper() + "_WIF"]
-    bot = SilentBot(bot_account, wif_map, curators, voters)
-    bot.run()
+    return lup, bot_account, wif_map, curators, voters
+
+if __name__ == "__main__":
+    # Any number of lookup files may be given, each one is a tenant sharing the block stream.
+    lupaths = sys.argv[1:]
+    if not lupaths:
+        lupaths = [os.path.join(os.path.dirname(os.path.realpath(__file__)),"sb-lookup.json")]
+    if "SILENTBOT_DATA_DIR" in os.environ:
+        datadir = os.environ["SILENTBOT_DATA_DIR"]
+    else:
+        datadir = os.path.dirname(os.path.realpath(__file__))
+    SamplingProfiler(datadir).install()
+    if "SILENTBOT_METRICS_PORT" in os.environ:
+        METRICS.serve(os.environ.get("SILENTBOT_METRICS_HOST", "127.0.0.1"), int(os.environ["SILENTBOT_METRICS_PORT"]))
+    if len(lupaths) == 1:
+        lup, bot_account, wif_map, curators, voters = load_tenant(lupaths[0])
+        bot = SilentBot(bot_account, wif_map, curators, voters, lupaths[0])
+        bot.run()
+    else:
+        tenants = []
+        pool = None
+        for lupath in lupaths:
+            lup, bot_account, wif_map, curators, voters = load_tenant(lupath)
+            if pool is None:
+                pool = ClientPool(lup.get("nodes", DEFAULT_NODES))
+            tenant_dir = os.path.join(datadir, bot_account)
+            os.makedirs(tenant_dir, exist_ok=True)
+            tenants.append(SilentBot(bot_account, wif_map, curators, voters, lupath, pool, tenant_dir))
+        MultiBot(tenants).run()